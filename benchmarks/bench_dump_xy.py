@@ -0,0 +1,63 @@
+"""Benchmark the skift.util training set writers against a per-row writer.
+
+The parallel writer is only used by skift.util.dump_xy when the
+SKIFT_DUMP_N_JOBS environment variable is set; run this first to check it
+beats the chunked serial writer on your hardware.
+
+Run with:
+
+    python benchmarks/bench_dump_xy.py [n_rows] [n_jobs]
+"""
+
+import os
+import sys
+import time
+import tempfile
+from functools import partial
+
+import numpy as np
+
+from skift.util import (
+    dump_xy_to_fasttext_format,
+    dump_xy_to_fasttext_format_parallel,
+)
+
+
+def per_row_dump_xy_to_fasttext_format(X, y, filepath):
+    """The original implementation: one format and write call per row."""
+    with open(filepath, 'w+', encoding='utf-8') as wfile:
+        for text, label in zip(X, y):
+            wfile.write('__label__{} {}\n'.format(label, text))
+
+
+def _rows_per_sec(dump_func, X, y, filepath):
+    start = time.perf_counter()
+    dump_func(X, y, filepath)
+    return len(X) / (time.perf_counter() - start)
+
+
+def main(n_rows=1000000, n_jobs=None):
+    rng = np.random.RandomState(0)
+    vocab = np.array(['word{}'.format(i) for i in range(5000)])
+    X = np.array([
+        ' '.join(words)
+        for words in rng.choice(vocab, size=(n_rows, 12))
+    ], dtype=object)
+    y = rng.randint(0, 100, size=n_rows)
+    fd, filepath = tempfile.mkstemp(suffix='.ft')
+    os.close(fd)
+    try:
+        for name, dump_func in [
+            ('per-row', per_row_dump_xy_to_fasttext_format),
+            ('chunked', dump_xy_to_fasttext_format),
+            ('parallel', partial(
+                dump_xy_to_fasttext_format_parallel, n_jobs=n_jobs)),
+        ]:
+            print('{:>8}: {:>12,.0f} rows/sec'.format(
+                name, _rows_per_sec(dump_func, X, y, filepath)))
+    finally:
+        os.remove(filepath)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,71 @@
+"""Benchmark in-memory fasttext model serialization against disk files.
+
+Compares a pickle-style round trip - model to bytes and back - through an
+anonymous memfd file with the same round trip through a file in the
+on-disk skift temp directory, across model sizes.
+
+Run with:
+
+    python benchmarks/bench_model_serialization.py [n_repeats]
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+from fasttext import train_supervised
+
+from skift import util
+
+
+def disk_round_trip(model):
+    """The original implementation: a temp file on the disk temp dir."""
+    with util.temp_file('model') as fpath:
+        bytes_obj = util._save_and_read_model(model, fpath)
+    with util.temp_file('model') as fpath:
+        util._write_and_load_model(bytes_obj, fpath)
+
+
+def memfd_round_trip(model):
+    with util.memory_file('skift_model') as fpath:
+        bytes_obj = util._save_and_read_model(model, fpath)
+    with util.memory_file('skift_model') as fpath:
+        util._write_and_load_model(bytes_obj, fpath)
+
+
+def _train_model(bucket, dim):
+    rng = np.random.RandomState(0)
+    vocab = np.array(['word{}'.format(i) for i in range(1000)])
+    with util.temp_file('trainset') as fpath:
+        with open(fpath, 'w', encoding='utf-8') as wfile:
+            for words in rng.choice(vocab, size=(2000, 10)):
+                wfile.write('__label__{} {}\n'.format(
+                    rng.randint(10), ' '.join(words)))
+        return train_supervised(
+            input=fpath, bucket=bucket, dim=dim, wordNgrams=2, epoch=1,
+            thread=1, verbose=0)
+
+
+def _seconds_per_round_trip(round_trip, model, n_repeats):
+    start = time.perf_counter()
+    for _ in range(n_repeats):
+        round_trip(model)
+    return (time.perf_counter() - start) / n_repeats
+
+
+def main(n_repeats=5):
+    if not util.MEMFD_SUPPORTED:
+        sys.exit('memfd_create is not supported on this platform')
+    os.environ[util.SKIFT_RAM_BUDGET_ENV_VAR] = '0'
+    for bucket, dim in [(10000, 50), (200000, 50), (2000000, 50)]:
+        model = _train_model(bucket, dim)
+        size_mb = len(util.python_fasttext_model_to_bytes(model)) / 2 ** 20
+        disk = _seconds_per_round_trip(disk_round_trip, model, n_repeats)
+        memfd = _seconds_per_round_trip(memfd_round_trip, model, n_repeats)
+        print('{:>8.1f} MB model: disk {:>8.4f}s, memfd {:>8.4f}s'.format(
+            size_mb, disk, memfd))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -17,7 +17,7 @@ TEST_REQUIRES = [
     # testing and coverage
     'pytest', 'coverage', 'pytest-cov',
     # unmandatory dependencies of the package itself
-    'pandas', 'lime',
+    'pandas', 'lime', 'pyarrow',
     # to be able to run `python setup.py checkdocs`
     'collective.checkdocs', 'pygments',
 ]
@@ -41,6 +41,7 @@ setuptools.setup(
     install_requires=INSTALL_REQUIRES,
     extras_require={
         'test': TEST_REQUIRES + INSTALL_REQUIRES,
+        'arrow': ['pyarrow'],
     },
     classifiers=[
         # Trove classifiers
@@ -5,12 +5,13 @@ from .core import IdxBasedFtClassifier  # noqa: F401
 from .core import FirstObjFtClassifier  # noqa: F401
 from .core import ColLblBasedFtClassifier  # noqa: F401
 from .core import SeriesFtClassifier  # noqa: F401
+from .mmap_model import load_mmap_classifier  # noqa: F401
 
 from ._version import get_versions
 __version__ = get_versions()['version']
 del get_versions
 
-for name in ['get_versions', '_version', 'core', 'name']:
+for name in ['get_versions', '_version', 'core', 'mmap_model', 'name']:
     try:
         globals().pop(name)
     except KeyError:
@@ -1,22 +1,202 @@
-
 """scikit-learn classifier wrapper for fasttext."""
 
 import os
 import abc
+import pickle
+import threading
+from itertools import chain, islice
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 import numpy as np
-from fasttext import train_supervised
+from scipy.sparse import csr_matrix
+from fasttext import train_supervised, load_model
 # from fasttext.FastText import unsupervised_default
 from sklearn.base import BaseEstimator, ClassifierMixin
 from sklearn.utils.multiclass import unique_labels
 from sklearn.exceptions import NotFittedError
 
 from .util import (
-    temp_dataset_fpath,
-    dump_xy_to_fasttext_format,
+    temp_file,
+    dataset_file,
+    estimate_model_size,
+    dump_xy_chunks_to_fasttext_format,
     python_fasttext_model_to_bytes,
     bytes_to_python_fasttext_model,
+    PredictionCache,
+    lazy_load_enabled,
 )
+from .mmap_model import MmapFastTextModel, save_mmap_classifier
+
+
+_LAZY_LOAD_LOCK = threading.Lock()
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:  # pragma: no cover
+        raise ImportError(
+            "Arrow output requires the pyarrow package. Install it with "
+            "`pip install pyarrow`.")
+    return pyarrow
+
+
+def _arrow_strings(str_arr):
+    """Returns Arrow-backed text input as a pyarrow array, else None.
+
+    Handles pyarrow Arrays and ChunkedArrays, and pandas Series or arrays
+    with a string[pyarrow] or pandas.ArrowDtype dtype.
+    """
+    if hasattr(str_arr, 'to_pylist'):
+        return str_arr
+    ext_arr = getattr(str_arr, 'array', str_arr)
+    dtype = getattr(ext_arr, 'dtype', None)
+    is_arrow_backed = hasattr(dtype, 'pyarrow_dtype') or (
+        getattr(dtype, 'storage', None) in ('pyarrow', 'pyarrow_numpy'))
+    if is_arrow_backed and hasattr(ext_arr, '__arrow_array__'):
+        return ext_arr.__arrow_array__()
+    return None
+
+
+def _iter_chunks(iterable, chunk_size):
+    """Yields consecutive lists of at most chunk_size items of iterable."""
+    arrow_strings = _arrow_strings(iterable)
+    if arrow_strings is not None:
+        # only one chunk at a time is converted to Python strings
+        for offset in range(0, len(arrow_strings), chunk_size):
+            yield arrow_strings.slice(offset, chunk_size).to_pylist()
+        return
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, chunk_size))
+
+
+def _effective_n_jobs(n_jobs):
+    """Resolves an sklearn-style n_jobs value to a positive worker count."""
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(1, (os.cpu_count() or 1) + 1 + n_jobs)
+    if n_jobs == 0:
+        raise ValueError("n_jobs == 0 has no meaning.")
+    return n_jobs
+
+
+def _imap_bounded(executor, func, iterable, max_in_flight, *args):
+    """Lazily maps func over iterable in executor, yielding results in order.
+
+    At most max_in_flight items are submitted ahead of the consumer, so the
+    input iterable is streamed rather than queued up front.
+    """
+    futures = deque()
+    for item in iterable:
+        if len(futures) >= max_in_flight:
+            yield futures.popleft().result()
+        futures.append(executor.submit(func, item, *args))
+    while futures:
+        yield futures.popleft().result()
+
+
+def _scatter_probas(labels, probs, class_index, probas):
+    """Scatters batched fasttext results into the class columns of probas."""
+    row_lens = [len(row_labels) for row_labels in labels]
+    rows = np.repeat(np.arange(len(labels)), row_lens)
+    cols = np.fromiter(
+        (class_index[lbl] for row_labels in labels for lbl in row_labels),
+        dtype=np.intp, count=len(rows))
+    if len(rows):
+        probas[rows, cols] = np.concatenate(probs)
+
+
+# state of process-pool prediction workers, set by _init_predict_worker
+_WORKER_STATE = {}
+
+
+def _init_predict_worker(model_fpath, class_labels, loader=load_model):
+    _WORKER_STATE['model'] = loader(model_fpath)
+    _WORKER_STATE['class_index'] = {
+        lbl: i for i, lbl in enumerate(class_labels)}
+
+
+def _predict_chunk_in_worker(chunk, probas, k=None, threshold=0.0):
+    """Scores a chunk in a worker, into class columns or probabilities."""
+    class_index = _WORKER_STATE['class_index']
+    if probas:
+        labels, probs = _WORKER_STATE['model'].predict(
+            chunk, k or len(class_index), threshold)
+        chunk_probas = np.zeros(
+            (len(chunk), len(class_index)), dtype=np.float64)
+        _scatter_probas(labels, probs, class_index, chunk_probas)
+        return chunk_probas
+    labels, _ = _WORKER_STATE['model'].predict(chunk, 1)
+    return np.fromiter(
+        (class_index[row_labels[0]] for row_labels in labels),
+        dtype=np.intp, count=len(labels))
+
+
+def _categorical_parts(str_arr):
+    """Returns (categories, codes) of pandas Categorical input, else None."""
+    categorical = getattr(str_arr, 'cat', str_arr)  # Series .cat accessor
+    try:
+        return categorical.categories, np.asarray(categorical.codes)
+    except AttributeError:
+        return None
+
+
+def _factorize(str_arr):
+    """Returns the unique texts of str_arr and the inverse indices into them.
+
+    The categories and codes of pandas Categorical inputs are used directly.
+    """
+    categorical_parts = _categorical_parts(str_arr)
+    if categorical_parts is not None:
+        categories, codes = categorical_parts
+        if (codes < 0).any():
+            raise ValueError(
+                "Categorical text input must not contain missing values.")
+        return list(categories), codes
+    arrow_strings = _arrow_strings(str_arr)
+    if arrow_strings is not None:
+        if hasattr(arrow_strings, 'combine_chunks'):
+            arrow_strings = arrow_strings.combine_chunks()
+        encoded = arrow_strings.dictionary_encode()
+        if encoded.null_count:
+            raise ValueError("Text input must not contain missing values.")
+        return encoded.dictionary.to_pylist(), encoded.indices.to_numpy()
+    text_index = {}
+    codes = np.fromiter(
+        (text_index.setdefault(text, len(text_index)) for text in str_arr),
+        dtype=np.intp, count=len(str_arr))
+    return list(text_index), codes
+
+
+def _column(X, ix):
+    """Extracts column ix of a 2-d input without copying the whole of it.
+
+    DataFrame and pyarrow Table columns are taken by position and ndarray
+    columns as views; for lists of rows only the requested items are
+    gathered.
+    """
+    try:
+        return X.iloc[:, ix]
+    except AttributeError:
+        pass
+    if hasattr(X, 'column'):  # pyarrow Table or RecordBatch
+        return X.column(ix)
+    if isinstance(X, np.ndarray):
+        return X[:, ix]
+    return [row[ix] for row in X]
+
+
+def _slice_rows(str_arr, rows):
+    """Positionally slices an array, list or pandas.Series of strings."""
+    try:
+        return str_arr.iloc[rows]
+    except AttributeError:
+        return str_arr[rows]
 
 
 class FtClassifierABC(BaseEstimator, ClassifierMixin, metaclass=abc.ABCMeta):
@@ -31,22 +211,76 @@ class FtClassifierABC(BaseEstimator, ClassifierMixin, metaclass=abc.ABCMeta):
         self.kwargs = kwargs
         self.kwargs.pop('input', None)  # remove the 'input' arg, if given
         self.model = None
+        self._prediction_cache = None
+
+    @property
+    def model(self):
+        """The underlying fasttext model; None if not fitted.
+
+        Models unpickled in lazy mode are only loaded here, on first access.
+        """
+        if self.__dict__.get('_model_bytes') is not None:
+            with _LAZY_LOAD_LOCK:
+                # re-checked, as another thread might have loaded it
+                if self._model_bytes is not None:
+                    self._model = bytes_to_python_fasttext_model(
+                        self._model_bytes)
+                    self._model_bytes = None
+        return self.__dict__.get('_model')
+
+    @model.setter
+    def model(self, model):
+        self._model = model
+        self._model_bytes = None
+
+    def is_model_loaded(self):
+        """Returns False if the model was lazily unpickled but not yet used.
+        """
+        return self.__dict__.get('_model_bytes') is None
 
     def __getstate__(self):
-        if self.model is not None:
-            model_pickle = python_fasttext_model_to_bytes(self.model)
-            pickle_dict = self.__dict__.copy()
-            pickle_dict['model'] = model_pickle
-            return pickle_dict
-        return self.__dict__
+        pickle_dict = self.__dict__.copy()
+        model_bytes = pickle_dict.pop('_model_bytes', None)
+        model = pickle_dict.pop('_model', None)
+        if isinstance(model, MmapFastTextModel):
+            # pickled by reference to its exported files
+            model_bytes = model
+        elif model_bytes is None and model is not None:
+            model_bytes = python_fasttext_model_to_bytes(model)
+        # a lazily unpickled model is passed on without loading it
+        pickle_dict['model'] = model_bytes
+        return pickle_dict
+
+    def __reduce_ex__(self, protocol):
+        reduced = super().__reduce_ex__(protocol)
+        state = reduced[2]
+        if isinstance(state, dict) and state.get('model') is not None and (
+                not isinstance(state['model'], MmapFastTextModel)):
+            if protocol >= 5:
+                # lets pickle hand the model payload out-of-band, uncopied
+                model_bytes = pickle.PickleBuffer(state['model'])
+            else:
+                model_bytes = bytes(state['model'])
+            state = {**state, 'model': model_bytes}
+            reduced = reduced[:2] + (state,) + reduced[3:]
+        return reduced
 
     def __setstate__(self, dicti):
         for key in dicti:
             if key == 'model':
-                unpic_model = bytes_to_python_fasttext_model(dicti[key])
-                setattr(self, 'model', unpic_model)
+                if isinstance(dicti[key], MmapFastTextModel):
+                    self.model = dicti[key]
+                elif lazy_load_enabled():
+                    self._model = None
+                    self._model_bytes = dicti[key]
+                else:
+                    self.model = bytes_to_python_fasttext_model(dicti[key])
             else:
                 setattr(self, key, dicti[key])
+        if 'class_labels_' in dicti:
+            # also covers objects pickled before class_index_ was introduced
+            self._index_class_labels()
+        self._clear_prediction_cache()
 
     def get_params(self, deep=True):
         """Get parameters for this estimator.
@@ -69,16 +303,21 @@ class FtClassifierABC(BaseEstimator, ClassifierMixin, metaclass=abc.ABCMeta):
 
     ALLOWED_DTYPES_ = ['<U26', object]
 
+    # number of strings sent to fasttext in each batched predict call
+    PREDICT_CHUNK_SIZE = 10000
+
     @staticmethod
     def _validate_x(X):
         try:
-            if len(X.shape) != 2:
-                raise ValueError(
-                    "FastTextClassifier methods must get a two-dimensional "
-                    "numpy array (or castable) as the X parameter.")
-            return X
+            ndim = len(X.shape)
         except AttributeError:
-            return FtClassifierABC._validate_x(np.array(X))
+            # e.g. a list of rows; infer its nesting without copying it
+            ndim = 1 + np.ndim(X[0]) if len(X) else 1
+        if ndim != 2:
+            raise ValueError(
+                "FastTextClassifier methods must get a two-dimensional "
+                "numpy array (or castable) as the X parameter.")
+        return X
 
     @staticmethod
     def _validate_y(y):
@@ -128,6 +367,172 @@ class FtClassifierABC(BaseEstimator, ClassifierMixin, metaclass=abc.ABCMeta):
         return self._fit_input_col(
             input_col, y, input_col_validation, y_validation)
 
+    def set_prediction_cache(self, maxsize):
+        """Enables a bounded LRU cache of prediction results by input text.
+
+        predict, predict_proba and predict_proba_on_str_arr serve repeated
+        texts from the cache instead of re-running the model. The cache is
+        emptied whenever the model changes, by fit, quantize or unpickling.
+        Worker processes of the 'multiprocessing' backend do not use it.
+
+        Parameters
+        ----------
+        maxsize : int or None
+            The maximal number of cached per-text results. None disables
+            the cache.
+        """
+        if maxsize is None:
+            self._prediction_cache = None
+        else:
+            self._prediction_cache = PredictionCache(maxsize)
+
+    def prediction_cache_info(self):
+        """Returns the statistics of the prediction cache.
+
+        Returns
+        -------
+        info : CacheInfo or None
+            The hits, misses, evictions, maxsize and currsize of the
+            prediction cache, or None if it is not enabled.
+        """
+        cache = getattr(self, '_prediction_cache', None)
+        if cache is None:
+            return None
+        return cache.info()
+
+    def _clear_prediction_cache(self):
+        cache = getattr(self, '_prediction_cache', None)
+        if cache is not None:
+            cache.clear()
+
+    def _index_class_labels(self):
+        # map each fasttext label to its column in predict_proba output
+        self.class_index_ = {
+            lbl: i for i, lbl in enumerate(self.class_labels_)}
+
+    def _train(self, trainset_fpath, validation_fpath=None):
+        if validation_fpath is None:
+            self.model = train_supervised(
+                input=trainset_fpath, **self.kwargs)
+        else:
+            self.model = train_supervised(
+                input=trainset_fpath,
+                **{
+                    'autotuneValidationFile': validation_fpath,
+                    **self.kwargs
+                }
+            )
+
+    @staticmethod
+    def _parse_label(lbl):
+        # only lossless, so labels like '7' and '007' never collapse
+        try:
+            value = int(lbl)
+        except ValueError:
+            return lbl
+        return value if str(value) == lbl else lbl
+
+    def _classes_from_model(self):
+        # recover classes_ from the label dictionary of the trained model
+        prefix = self.kwargs.get('label', '__label__')
+        class_labels = self.model.get_labels()
+        classes = [self._parse_label(lbl[len(prefix):])
+                   for lbl in class_labels]
+        if not all(isinstance(cls, int) for cls in classes):
+            classes = [lbl[len(prefix):] for lbl in class_labels]
+        order = sorted(range(len(classes)), key=classes.__getitem__)
+        self.classes_ = np.array([classes[i] for i in order])
+        self.num_classes_ = len(self.classes_)
+        self.class_labels_ = [class_labels[i] for i in order]
+        self._index_class_labels()
+
+    def fit_from_file(self, path, validation_path=None):
+        """Fits the classifier on an existing fasttext-format file.
+
+        The file is handed to fasttext as is, so its text is never read
+        into Python. classes_ are derived from the labels of the trained
+        model; they are ints if all labels are integers written as such -
+        e.g. '7', but not '007' - and str otherwise.
+
+        Parameters
+        ----------
+        path : str
+            The path of a training file in fasttext format; i.e. a
+            '__label__<class> <text>' line per sample.
+        validation_path : str, optional
+            The path of a validation file in fasttext format, used for
+            hyperparameter auto-tuning.
+
+        Returns
+        -------
+        self : object
+            Returns self.
+        """
+        for fpath in (path, validation_path):
+            if fpath is not None and not os.path.isfile(fpath):
+                raise FileNotFoundError(
+                    "No such training file: '{}'".format(fpath))
+        self._clear_prediction_cache()
+        self._train(path, validation_path)
+        self._classes_from_model()
+        return self
+
+    def _set_classes(self, classes):
+        self.classes_ = classes
+        self.num_classes_ = len(self.classes_)
+        self.class_labels_ = [
+            '__label__{}'.format(lbl) for lbl in self.classes_]
+        self._index_class_labels()
+
+    def _chunk_input_col(self, X):
+        self._validate_x(X)
+        return self._input_col(X)
+
+    def _dump_chunks(self, chunks, fpath):
+        return dump_xy_chunks_to_fasttext_format((
+            (self._chunk_input_col(X), self._validate_y(y))
+            for X, y in chunks
+        ), fpath)
+
+    def fit_stream(self, chunks, validation_chunks=None):
+        """Fits the classifier on an iterable of (X, y) chunks.
+
+        Each chunk is appended to the fasttext training file as it is
+        consumed, and the set of classes is collected on the fly, so the
+        training set never has to fit in memory.
+
+        Parameters
+        ----------
+        chunks : iterable of (X, y) pairs
+            The training input samples, in the same form fit expects, and
+            their target values; e.g. a generator over the chunks of
+            pandas.read_csv(..., chunksize=n).
+        validation_chunks : iterable of (X, y) pairs, optional
+            The validation input samples and target values.
+
+        Returns
+        -------
+        self : object
+            Returns self.
+        """
+        self._clear_prediction_cache()
+        with temp_file('trainset') as trainset_fpath:
+            labels = self._dump_chunks(chunks, trainset_fpath)
+            if not labels:
+                raise ValueError("No training samples were streamed.")
+            self._set_classes(unique_labels(np.array(sorted(labels))))
+            if validation_chunks is None:
+                self._train(trainset_fpath)
+                return self
+            with temp_file('trainset') as validation_fpath:
+                labels = self._dump_chunks(
+                    validation_chunks, validation_fpath)
+                assert len(labels) == self.num_classes_, (
+                    "Number of validation classes doesn't match number of "
+                    "training classes")
+                self._train(trainset_fpath, validation_fpath)
+        return self
+
     def _fit_input_col(
         self,
         input_col,
@@ -135,115 +540,389 @@ class FtClassifierABC(BaseEstimator, ClassifierMixin, metaclass=abc.ABCMeta):
         input_col_validation=None,
         y_validation=None,
     ):
+        self._clear_prediction_cache()
         # Store the classes seen during fit
-        self.classes_ = unique_labels(y)
-        self.num_classes_ = len(self.classes_)
-        self.class_labels_ = [
-            '__label__{}'.format(lbl) for lbl in self.classes_]
-        # Dump training set to a fasttext-compatible file
-        temp_trainset_fpath = temp_dataset_fpath()
-        dump_xy_to_fasttext_format(input_col, y, temp_trainset_fpath)
+        self._set_classes(unique_labels(y))
         if input_col_validation is not None:
             n_classes_validation = len(unique_labels(y_validation))
-            assert n_classes_validation == self.num_classes_,\
-                ("Number of validation classes doesn't match number of "
-                 "training classes")
-            temp_trainset_fpath_validation = temp_dataset_fpath()
-            dump_xy_to_fasttext_format(
-                input_col_validation,
-                y_validation,
-                temp_trainset_fpath_validation,
-            )
-            # train
-            self.model = train_supervised(
-                input=temp_trainset_fpath,
-                **{
-                    'autotuneValidationFile': temp_trainset_fpath_validation,
-                    **self.kwargs
-                }
-            )
-            try:
-                os.remove(temp_trainset_fpath_validation)
-            except FileNotFoundError:  # pragma: no cover
-                pass
-        else:
-            self.model = train_supervised(
-                input=temp_trainset_fpath, **self.kwargs)
-
-        # Return the classifier
-        try:
-            os.remove(temp_trainset_fpath)
-        except FileNotFoundError:  # pragma: no cover
-            pass
-
+            assert n_classes_validation == self.num_classes_, (
+                "Number of validation classes doesn't match number of "
+                "training classes")
+        # Dump training set to a fasttext-compatible file, removed after
+        # training even if it fails
+        with dataset_file(input_col, y) as trainset_fpath:
+            if input_col_validation is None:
+                self._train(trainset_fpath)
+                return self
+            with dataset_file(
+                    input_col_validation, y_validation) as validation_fpath:
+                self._train(trainset_fpath, validation_fpath)
         return self
 
-    @staticmethod
-    def _clean_label(ft_label):
-        try:
-            res = int(ft_label[9:])
-        except ValueError:
-            res = ft_label[9:]
-
-        return res
+    def _predict_on_str_arr(
+            self, str_arr, k=1, chunk_size=None, threshold=0.0):
+        """Yields a fasttext (labels, probabilities) result per input chunk."""
+        if chunk_size is None:
+            chunk_size = self.PREDICT_CHUNK_SIZE
+        cache = getattr(self, '_prediction_cache', None)
+        for chunk in _iter_chunks(str_arr, chunk_size):
+            if cache is None:
+                yield self.model.predict(chunk, k, threshold)
+            else:
+                yield cache.predict(self.model, chunk, k, threshold)
 
-    def _predict_on_str_arr(self, str_arr, k=1):
-        return (self.model.predict(text, k) for text in str_arr)
+    @staticmethod
+    def _map_shards(func, str_arr, n_jobs=None):
+        """Applies func(shard, rows) to row shards of str_arr in a thread pool.
 
-    def _predict(self, X, k=1):
-        # Ensure that fit had been called
+        Returns the list of per-shard results, in shard order.
+        """
+        n_samples = len(str_arr)
+        bounds = np.linspace(
+            0, n_samples, min(_effective_n_jobs(n_jobs), n_samples) + 1,
+        ).astype(int)
+        shard_rows = [
+            slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+        if len(shard_rows) <= 1:
+            return [func(str_arr, slice(0, n_samples))]
+        with ThreadPoolExecutor(max_workers=len(shard_rows)) as executor:
+            futures = [
+                executor.submit(func, _slice_rows(str_arr, rows), rows)
+                for rows in shard_rows
+            ]
+            return [future.result() for future in futures]
+
+    def _check_fitted(self):
         if self.model is None:
             raise NotFittedError("This {} instance is not fitted yet.".format(
                 self.__class__.__name__))
 
+    def _predict_input(self, X):
+        # Ensure that fit had been called
+        self._check_fitted()
+
         # Input validation{
         self._validate_x(X)
-        return self._predict_on_str_arr(self._input_col(X), k=k)
+        return self._input_col(X)
+
+    PREDICT_BACKENDS = ('threading', 'multiprocessing')
+
+    def _use_process_pool(self, n_jobs, backend):
+        if backend not in self.PREDICT_BACKENDS:
+            raise ValueError("backend must be one of {}, got {!r}.".format(
+                self.PREDICT_BACKENDS, backend))
+        return backend == 'multiprocessing' and _effective_n_jobs(n_jobs) > 1
 
-    def predict(self, X):
+    def _process_pool_results(
+            self, str_arr, probas, chunk_size=None, n_jobs=None, k=None,
+            threshold=0.0):
+        """Yields per-chunk results scored by a pool of worker processes.
+
+        The model is saved to a single temporary file, which every worker
+        loads once in its initializer; only input chunks and result arrays
+        are sent between processes.
+        """
+        if chunk_size is None:
+            chunk_size = self.PREDICT_CHUNK_SIZE
+        return self._process_pool_chunk_results(
+            _iter_chunks(str_arr, chunk_size), probas, n_jobs, k, threshold)
+
+    def _process_pool_chunk_results(
+            self, chunks, probas, n_jobs=None, k=None, threshold=0.0):
+        n_workers = _effective_n_jobs(n_jobs)
+        if isinstance(self.model, MmapFastTextModel):
+            # workers map the same files, sharing the model's memory
+            yield from self._pool_results_from_model_file(
+                self.model.dirpath, MmapFastTextModel, chunks, probas,
+                n_workers, k, threshold)
+            return
+        model_size = estimate_model_size(self.model)
+        with temp_file('model', model_size) as model_fpath:
+            self.model.save_model(model_fpath)
+            yield from self._pool_results_from_model_file(
+                model_fpath, load_model, chunks, probas, n_workers, k,
+                threshold)
+
+    def _pool_results_from_model_file(
+            self, model_fpath, loader, chunks, probas, n_workers, k,
+            threshold):
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            initializer=_init_predict_worker,
+            initargs=(model_fpath, self.class_labels_, loader),
+        ) as executor:
+            yield from _imap_bounded(
+                executor, _predict_chunk_in_worker, chunks, 2 * n_workers,
+                probas, k, threshold)
+
+    def _dedup_process_pool_results(
+            self, texts, probas, chunk_size=None, n_jobs=None, dedup=None):
+        """Yields process pool results per chunk of texts, deduping each.
+
+        Only the unique texts of a chunk are sent to the workers; their
+        results are expanded back to all rows of the chunk in this process.
+        """
+        codes_per_chunk = deque()
+
+        def unique_chunks():
+            for chunk in _iter_chunks(
+                    texts, chunk_size or self.PREDICT_CHUNK_SIZE):
+                dedupped = self._dedup_rows(chunk, dedup)
+                if dedupped is None:
+                    codes_per_chunk.append(None)
+                    yield chunk
+                else:
+                    codes_per_chunk.append(dedupped[1])
+                    yield dedupped[0]
+
+        # results arrive in chunk order, so codes are matched FIFO
+        for result in self._process_pool_chunk_results(
+                unique_chunks(), probas, n_jobs):
+            codes = codes_per_chunk.popleft()
+            yield result if codes is None else result.take(codes, axis=0)
+
+    def _labels_from_cols(self, cols):
+        """Decodes predict_proba column indices into classes_ values.
+
+        class_index_ and classes_ together form the decoding table from
+        fasttext labels to the original class values, keeping their dtype;
+        e.g. the label '007' is not turned into the int 7.
+        """
+        return self.classes_.take(cols)
+
+    @staticmethod
+    def _dedup_rows(str_arr, dedup):
+        """Returns (unique texts, inverse indices) if dedup applies."""
+        if dedup is None:
+            dedup = _categorical_parts(str_arr) is not None
+        if dedup:
+            return _factorize(str_arr)
+        return None
+
+    def _cols_on_str_arr(
+            self, str_arr, chunk_size=None, n_jobs=None, backend='threading',
+            dedup=False):
+        """Returns the class column of the top label predicted per text."""
+        dedupped = self._dedup_rows(str_arr, dedup)
+        if dedupped is not None:
+            uniques, codes = dedupped
+            return self._cols_on_str_arr(
+                uniques, chunk_size=chunk_size, n_jobs=n_jobs,
+                backend=backend).take(codes)
+        if self._use_process_pool(n_jobs, backend):
+            return np.fromiter(chain.from_iterable(
+                self._process_pool_results(
+                    str_arr, False, chunk_size=chunk_size, n_jobs=n_jobs)),
+                dtype=np.intp, count=len(str_arr))
+        cols = np.empty(len(str_arr), dtype=np.intp)
+
+        def fill_shard(shard, rows):
+            start = rows.start
+            for labels, _ in self._predict_on_str_arr(
+                    shard, chunk_size=chunk_size):
+                cols[start:start + len(labels)] = np.fromiter(
+                    (self.class_index_[row_lbls[0]] for row_lbls in labels),
+                    dtype=np.intp, count=len(labels))
+                start += len(labels)
+
+        self._map_shards(fill_shard, str_arr, n_jobs)
+        return cols
+
+    def _labels_on_str_arr(self, str_arr, **kwargs):
+        return self._labels_from_cols(self._cols_on_str_arr(str_arr, **kwargs))
+
+    def predict(
+            self, X, chunk_size=None, n_jobs=None, backend='threading',
+            dedup=None):
         """Predict labels.
 
         Parameters
         ----------
         X : array-like of shape = [n_samples, n_features]
             The input samples.
+        chunk_size : int, optional
+            The number of samples sent to fasttext in each batched predict
+            call. Defaults to PREDICT_CHUNK_SIZE.
+        n_jobs : int, optional
+            The number of threads scoring shards of X against the shared
+            fasttext model. None means 1, and -1 means using all processors.
+        backend : {'threading', 'multiprocessing'}, default 'threading'
+            With 'multiprocessing', n_jobs worker processes each load the
+            model once and score streamed chunks of X instead of threads.
+        dedup : bool, optional
+            If True, only the unique texts of X are scored, and their results
+            are expanded back to all rows. By default this is done only for
+            pandas Categorical text input, whose categories and codes are
+            used directly.
 
         Returns
         -------
-        y : array of int of shape = [n_samples]
-            Predicted labels for the given input samples.
+        y : array of shape = [n_samples]
+            Predicted labels for the given input samples, of the dtype of
+            the classes_ attribute.
         """
-        return np.array([
-            self._clean_label(res[0][0])
-            for res in self._predict(X)
-        ])
-
-    def _format_probas(self, result):
-        lbl_prob_pairs = zip(result[0], result[1])
-        sorted_lbl_prob_pairs = sorted(
-            lbl_prob_pairs, key=lambda x: self.class_labels_.index(x[0]))
-        return [x[1] for x in sorted_lbl_prob_pairs]
-
-    def predict_proba(self, X):
+        return self._labels_on_str_arr(
+            self._predict_input(X), chunk_size=chunk_size, n_jobs=n_jobs,
+            backend=backend, dedup=dedup)
+
+    def _fill_probas(
+            self, str_arr, probas, chunk_size=None, k=None, threshold=0.0):
+        start = 0
+        for labels, probs in self._predict_on_str_arr(
+                str_arr, k=k or self.num_classes_, chunk_size=chunk_size,
+                threshold=threshold):
+            chunk_probas = probas[start:start + len(labels)]
+            chunk_probas[:] = 0
+            _scatter_probas(labels, probs, self.class_index_, chunk_probas)
+            start += len(labels)
+
+    def _sparse_probas_on_str_arr(
+            self, str_arr, chunk_size=None, n_jobs=None, k=None,
+            threshold=0.0, dtype=np.float64):
+        def shard_entries(shard, rows):
+            row_lens, cols, data = [], [], []
+            for labels, probs in self._predict_on_str_arr(
+                    shard, k=k or self.num_classes_, chunk_size=chunk_size,
+                    threshold=threshold):
+                row_lens.append(np.fromiter(
+                    map(len, labels), dtype=np.intp, count=len(labels)))
+                cols.append(np.fromiter(
+                    (self.class_index_[lbl]
+                     for row_labels in labels for lbl in row_labels),
+                    dtype=np.intp, count=row_lens[-1].sum()))
+                data.extend(probs)
+            return row_lens, cols, data
+
+        shards = self._map_shards(shard_entries, str_arr, n_jobs)
+        indptr = np.zeros(len(str_arr) + 1, dtype=np.intp)
+        np.cumsum(
+            np.concatenate([np.empty(0, dtype=np.intp)] + [
+                lens for row_lens, _, _ in shards for lens in row_lens]),
+            out=indptr[1:])
+        indices = np.concatenate([np.empty(0, dtype=np.intp)] + [
+            chunk_cols for _, cols, _ in shards for chunk_cols in cols])
+        data = np.concatenate([np.empty(0, dtype=np.float64)] + [
+            row_probs for _, _, data in shards for row_probs in data])
+        probas = csr_matrix(
+            (data.astype(dtype), indices, indptr),
+            shape=(len(str_arr), self.num_classes_))
+        probas.sort_indices()
+        return probas
+
+    @staticmethod
+    def _validate_out(out, shape, sparse_output):
+        if sparse_output:
+            raise ValueError("out is not supported with sparse_output.")
+        if out.shape != shape:
+            raise ValueError(
+                "out must be of shape {}, got {}.".format(shape, out.shape))
+        # probabilities would be silently truncated to 0 otherwise
+        if not np.issubdtype(out.dtype, np.floating):
+            raise ValueError(
+                "out must be of a floating point dtype, got {}.".format(
+                    out.dtype))
+
+    def _probas_on_str_arr(
+            self, str_arr, chunk_size=None, n_jobs=None, backend='threading',
+            dedup=False, k=None, threshold=0.0, sparse_output=False,
+            out=None, dtype=np.float64):
+        shape = (len(str_arr), self.num_classes_)
+        if out is not None:
+            self._validate_out(out, shape, sparse_output)
+            dtype = out.dtype
+        dedupped = self._dedup_rows(str_arr, dedup)
+        if dedupped is not None:
+            uniques, codes = dedupped
+            probas = self._probas_on_str_arr(
+                uniques, chunk_size=chunk_size, n_jobs=n_jobs,
+                backend=backend, k=k, threshold=threshold,
+                sparse_output=sparse_output, dtype=dtype)
+            if sparse_output:
+                return probas[codes]
+            return np.take(probas, codes, axis=0, out=out)
+        use_process_pool = self._use_process_pool(n_jobs, backend)
+        if sparse_output:
+            if use_process_pool:
+                raise ValueError(
+                    "sparse_output is not supported by the multiprocessing "
+                    "backend.")
+            return self._sparse_probas_on_str_arr(
+                str_arr, chunk_size=chunk_size, n_jobs=n_jobs, k=k,
+                threshold=threshold, dtype=dtype)
+        probas = np.empty(shape, dtype=dtype) if out is None else out
+        if use_process_pool:
+            start = 0
+            for chunk_probas in self._process_pool_results(
+                    str_arr, True, chunk_size=chunk_size, n_jobs=n_jobs, k=k,
+                    threshold=threshold):
+                probas[start:start + len(chunk_probas)] = chunk_probas
+                start += len(chunk_probas)
+            return probas
+
+        def fill_shard(shard, rows):
+            self._fill_probas(
+                shard, probas[rows], chunk_size=chunk_size, k=k,
+                threshold=threshold)
+
+        self._map_shards(fill_shard, str_arr, n_jobs)
+        return probas
+
+    def predict_proba(
+            self, X, chunk_size=None, n_jobs=None, backend='threading',
+            dedup=None, sparse_output=False, k=None, threshold=0.0,
+            out=None, dtype=np.float64):
         """Predict class probabilities for X.
 
         Parameters
         ----------
         X : array-like of shape = [n_samples, n_features]
             The input samples.
+        chunk_size : int, optional
+            The number of samples sent to fasttext in each batched predict
+            call. Defaults to PREDICT_CHUNK_SIZE.
+        n_jobs : int, optional
+            The number of threads scoring shards of X against the shared
+            fasttext model. None means 1, and -1 means using all processors.
+        backend : {'threading', 'multiprocessing'}, default 'threading'
+            With 'multiprocessing', n_jobs worker processes each load the
+            model once and score streamed chunks of X instead of threads.
+        dedup : bool, optional
+            If True, only the unique texts of X are scored, and their results
+            are expanded back to all rows. By default this is done only for
+            pandas Categorical text input, whose categories and codes are
+            used directly.
+        sparse_output : bool, default False
+            If True, return a scipy.sparse.csr_matrix holding only the
+            probabilities fasttext returned, as selected by k and threshold.
+            Not supported by the 'multiprocessing' backend.
+        k : int, optional
+            The number of most probable classes requested per sample; the
+            rest get a probability of zero. Defaults to all classes.
+        threshold : float, default 0.0
+            Classes with a lower probability get a probability of zero.
+
+        out : array of shape = [n_samples, n_classes], optional
+            A preallocated floating point array, such as a numpy.memmap,
+            into which the probabilities are written in place, chunk by
+            chunk.
+        dtype : numpy dtype, default numpy.float64
+            The dtype of the returned probabilities, e.g. numpy.float32.
+            Ignored if out is given.
 
         Returns
         -------
-        p : array of shape = [n_samples, n_classes]
+        p : array or csr_matrix of shape = [n_samples, n_classes]
             The class probabilities of the input samples. The order of the
             classes corresponds to that in the attribute classes_.
         """
-        return np.array([
-            self._format_probas(res)
-            for res in self._predict(X, self.num_classes_)
-        ], dtype=np.float_)
-
-    def predict_proba_on_str_arr(self, X):
+        return self._probas_on_str_arr(
+            self._predict_input(X), chunk_size=chunk_size, n_jobs=n_jobs,
+            backend=backend, dedup=dedup, sparse_output=sparse_output, k=k,
+            threshold=threshold, out=out, dtype=dtype)
+
+    def predict_proba_on_str_arr(
+            self, X, chunk_size=None, n_jobs=None, backend='threading',
+            dedup=None, out=None, dtype=np.float64):
         """Predict class probabilities for X, an array of strings.
 
         This is mainly meant to enable easy use of fitted classifier objects
@@ -253,6 +932,27 @@ class FtClassifierABC(BaseEstimator, ClassifierMixin, metaclass=abc.ABCMeta):
         ----------
         X : array-like of shape = [n_sammples]
             The input samples, each one a string object.
+        chunk_size : int, optional
+            The number of samples sent to fasttext in each batched predict
+            call. Defaults to PREDICT_CHUNK_SIZE.
+        n_jobs : int, optional
+            The number of threads scoring shards of X against the shared
+            fasttext model. None means 1, and -1 means using all processors.
+        backend : {'threading', 'multiprocessing'}, default 'threading'
+            With 'multiprocessing', n_jobs worker processes each load the
+            model once and score streamed chunks of X instead of threads.
+        dedup : bool, optional
+            If True, only the unique texts of X are scored, and their results
+            are expanded back to all rows. By default this is done only for
+            pandas Categorical text input, whose categories and codes are
+            used directly.
+        out : array of shape = [n_samples, n_classes], optional
+            A preallocated floating point array, such as a numpy.memmap,
+            into which the probabilities are written in place, chunk by
+            chunk.
+        dtype : numpy dtype, default numpy.float64
+            The dtype of the returned probabilities, e.g. numpy.float32.
+            Ignored if out is given.
 
         Returns
         -------
@@ -276,10 +976,179 @@ class FtClassifierABC(BaseEstimator, ClassifierMixin, metaclass=abc.ABCMeta):
         >>> exp = explainer.explain_instance(
         ...     'meow', classifier_fn=clf.predict_proba_on_str_arr);
         """
-        return np.array([
-            self._format_probas(res)
-            for res in self._predict_on_str_arr(X, k=self.num_classes_)
-        ], dtype=np.float_)
+        return self._probas_on_str_arr(
+            X, chunk_size=chunk_size, n_jobs=n_jobs, backend=backend,
+            dedup=dedup, out=out, dtype=dtype)
+
+    def _topk_on_str_arr(
+            self, str_arr, k, chunk_size=None, n_jobs=None, dedup=False):
+        dedupped = self._dedup_rows(str_arr, dedup)
+        if dedupped is not None:
+            uniques, codes = dedupped
+            cols, probas = self._topk_on_str_arr(
+                uniques, k, chunk_size=chunk_size, n_jobs=n_jobs)
+            return cols.take(codes, axis=0), probas.take(codes, axis=0)
+        cols = np.empty((len(str_arr), k), dtype=np.intp)
+        probas = np.empty((len(str_arr), k), dtype=np.float64)
+
+        def fill_shard(shard, rows):
+            start = rows.start
+            for labels, probs in self._predict_on_str_arr(
+                    shard, k=k, chunk_size=chunk_size):
+                stop = start + len(labels)
+                cols[start:stop] = np.fromiter(
+                    (self.class_index_[lbl]
+                     for row_labels in labels for lbl in row_labels),
+                    dtype=np.intp, count=len(labels) * k,
+                ).reshape(-1, k)
+                probas[start:stop] = probs
+                start = stop
+
+        self._map_shards(fill_shard, str_arr, n_jobs)
+        return cols, probas
+
+    def predict_topk(self, X, k, chunk_size=None, n_jobs=None, dedup=None):
+        """Predict the k most probable labels, and their probabilities.
+
+        Only k labels per sample are requested from fasttext, so this is much
+        cheaper than predict_proba for large label spaces.
+
+        Parameters
+        ----------
+        X : array-like of shape = [n_samples, n_features]
+            The input samples.
+        k : int
+            The number of labels to predict per sample. Values larger than
+            the number of classes are capped to it.
+        chunk_size, n_jobs, dedup
+            As in predict.
+
+        Returns
+        -------
+        y : array of shape = [n_samples, k]
+            The k most probable labels of each sample, most probable first.
+        p : array of shape = [n_samples, k]
+            The probabilities of the labels in y.
+        """
+        if k < 1:
+            raise ValueError("k must be a positive integer.")
+        str_arr = self._predict_input(X)
+        cols, probas = self._topk_on_str_arr(
+            str_arr, min(k, self.num_classes_), chunk_size=chunk_size,
+            n_jobs=n_jobs, dedup=dedup)
+        return self._labels_from_cols(cols), probas
+
+    def predict_arrow(self, X, **kwargs):
+        """Predict labels, as a pyarrow.Array.
+
+        Requires the pyarrow package. Keyword arguments are forwarded to
+        predict. Arrow-backed text input, such as a pyarrow Table or a
+        string[pyarrow] Series, is read one chunk at a time.
+        """
+        pyarrow = _import_pyarrow()
+        return pyarrow.array(self.predict(X, **kwargs))
+
+    def predict_proba_arrow(
+            self, X, chunk_size=None, n_jobs=None, backend='threading',
+            dedup=None, k=None, threshold=0.0, dtype=np.float64):
+        """Predict class probabilities for X, as a pyarrow.RecordBatch.
+
+        Requires the pyarrow package. The batch has one column per class,
+        named after its value in classes_ and in the same order. chunk_size,
+        n_jobs, backend, dedup, k, threshold and dtype are as in
+        predict_proba; its out and sparse_output arguments are not
+        supported, as the probabilities are written into the batch's own
+        column buffers.
+        """
+        pyarrow = _import_pyarrow()
+        str_arr = self._predict_input(X)
+        # column-major, so every class column is one contiguous buffer
+        probas = self._probas_on_str_arr(
+            str_arr, chunk_size=chunk_size, n_jobs=n_jobs, backend=backend,
+            dedup=dedup, k=k, threshold=threshold, out=np.empty(
+                (len(str_arr), self.num_classes_), dtype=dtype, order='F'))
+        return pyarrow.RecordBatch.from_arrays(
+            [pyarrow.array(probas[:, i]) for i in range(self.num_classes_)],
+            names=[str(cls) for cls in self.classes_],
+        )
+
+    def predict_iter(
+            self, texts, chunk_size=None, n_jobs=None, backend='threading',
+            dedup=None):
+        """Lazily predict labels for an iterable of texts, chunk by chunk.
+
+        texts is consumed in chunks of chunk_size strings, so memory use does
+        not grow with the number of texts.
+
+        Parameters
+        ----------
+        texts : iterable of str
+            The input texts; e.g. file lines or a database cursor.
+        chunk_size : int, optional
+            The number of texts read and scored at a time. Defaults to
+            PREDICT_CHUNK_SIZE.
+        n_jobs, backend, dedup
+            Applied to each chunk, as in predict. With the 'multiprocessing'
+            backend a single process pool scores all chunks, and only the
+            unique texts of deduped chunks are sent to it.
+
+        Yields
+        ------
+        y : array of shape = [chunk_size]
+            Predicted labels for consecutive chunks of texts. The last chunk
+            may be shorter.
+        """
+        self._check_fitted()
+        if self._use_process_pool(n_jobs, backend):
+            return (
+                self._labels_from_cols(cols)
+                for cols in self._dedup_process_pool_results(
+                    texts, False, chunk_size=chunk_size, n_jobs=n_jobs,
+                    dedup=dedup)
+            )
+        return (
+            self._labels_on_str_arr(chunk, n_jobs=n_jobs, dedup=dedup)
+            for chunk in _iter_chunks(
+                texts, chunk_size or self.PREDICT_CHUNK_SIZE)
+        )
+
+    def predict_proba_iter(
+            self, texts, chunk_size=None, n_jobs=None, backend='threading',
+            dedup=None):
+        """Lazily predict class probabilities for an iterable of texts.
+
+        texts is consumed in chunks of chunk_size strings, so memory use does
+        not grow with the number of texts.
+
+        Parameters
+        ----------
+        texts : iterable of str
+            The input texts; e.g. file lines or a database cursor.
+        chunk_size : int, optional
+            The number of texts read and scored at a time. Defaults to
+            PREDICT_CHUNK_SIZE.
+        n_jobs, backend, dedup
+            Applied to each chunk, as in predict_proba. With the
+            'multiprocessing' backend a single process pool scores all
+            chunks, and only the unique texts of deduped chunks are sent to
+            it.
+
+        Yields
+        ------
+        p : array of shape = [chunk_size, n_classes]
+            The class probabilities of consecutive chunks of texts. The last
+            chunk may be shorter.
+        """
+        self._check_fitted()
+        if self._use_process_pool(n_jobs, backend):
+            return self._dedup_process_pool_results(
+                texts, True, chunk_size=chunk_size, n_jobs=n_jobs,
+                dedup=dedup)
+        return (
+            self._probas_on_str_arr(chunk, n_jobs=n_jobs, dedup=dedup)
+            for chunk in _iter_chunks(
+                texts, chunk_size or self.PREDICT_CHUNK_SIZE)
+        )
 
     def quantize(self, **kwargs):
         """Quantize the model reducing its size and memory footprint.
@@ -288,12 +1157,31 @@ class FtClassifierABC(BaseEstimator, ClassifierMixin, metaclass=abc.ABCMeta):
         ``model.quantize`` method. See Python fasttext docymentation:
         https://github.com/facebookresearch/fastText/tree/master/python#model-object
         """
+        self._clear_prediction_cache()
         self.model.quantize(**kwargs)
 
     def is_quantized(self):
         """Return true if the inner fasttext model is quantized, else False."""
         return self.model.is_quantized()
 
+    def save_mmap(self, dirpath):
+        """Saves the classifier in a memory-mappable format.
+
+        The model matrices are saved as .npy files, which
+        skift.load_mmap_classifier memory-maps read-only; all processes
+        loading the same directory, e.g. the workers of a pre-fork server,
+        then share a single copy of the model in memory. Quantized models
+        and models trained with hierarchical softmax are not supported.
+
+        Parameters
+        ----------
+        dirpath : str
+            The directory to save the classifier to. Created if it does not
+            exist.
+        """
+        self._check_fitted()
+        save_mmap_classifier(self, dirpath)
+
 
 class FirstColFtClassifier(FtClassifierABC):
     """An sklearn classifier adapter for fasttext using the first column.
@@ -306,7 +1194,7 @@ class FirstColFtClassifier(FtClassifierABC):
     """
 
     def _input_col(self, X):
-        return np.array(X)[:, 0]
+        return _column(X, 0)
 
 
 class IdxBasedFtClassifier(FtClassifierABC):
@@ -325,7 +1213,7 @@ class IdxBasedFtClassifier(FtClassifierABC):
         self.input_ix = input_ix
 
     def _input_col(self, X):
-        return np.array(X)[:, self.input_ix]
+        return _column(X, self.input_ix)
 
     def get_params(self, deep=True):
         """Get parameters for this estimator.
@@ -418,6 +1306,12 @@ class SeriesFtClassifier(FtClassifierABC):
     def _input_col(self, X):
         pass
 
+    def _chunk_input_col(self, X):
+        try:
+            return X.values
+        except AttributeError:
+            return X
+
     def fit(self, X, y, X_validation=None, y_validation=None):
         """Fits the classifier
 
@@ -454,13 +1348,10 @@ class SeriesFtClassifier(FtClassifierABC):
         return self._fit_input_col(
             input_col, y, input_col_validation, y_validation)
 
-    def _predict(self, X, k=1):
+    def _predict_input(self, X):
         # Ensure that fit had been called
-        if self.model is None:
-            raise NotFittedError("This {} instance is not fitted yet.".format(
-                self.__class__.__name__))
+        self._check_fitted()
         try:
-            input_col = X.values
+            return X.values
         except AttributeError:
-            input_col = X
-        return self._predict_on_str_arr(input_col, k=k)
+            return X
@@ -0,0 +1,408 @@
+"""Memory-mapped fasttext models, for sharing models between processes.
+
+A supervised fasttext model is exported to a directory holding its input
+and output matrices as .npy files, next to its dictionary and arguments.
+MmapFastTextModel memory-maps the matrices read-only and reimplements
+fasttext's supervised inference on top of them, so all processes serving
+the same exported model - forked or independently started - share its
+physical memory pages instead of each holding a private copy.
+"""
+
+import os
+import re
+import json
+import pickle
+from functools import lru_cache
+
+import numpy as np
+
+INPUT_MATRIX_FNAME = 'input_matrix.npy'
+OUTPUT_MATRIX_FNAME = 'output_matrix.npy'
+DICTIONARY_FNAME = 'dictionary.json'
+WORD_INDEX_FNAME = 'word_index.npy'
+WORDS_FNAME = 'words.npy'
+WORD_OFFSETS_FNAME = 'word_offsets.npy'
+ESTIMATOR_FNAME = 'estimator.pkl'
+
+EOS = '</s>'
+BOW = '<'
+EOW = '>'
+SUPPORTED_LOSSES = ('softmax', 'ns', 'ova')
+
+# fasttext only splits tokens on these characters
+_TOKEN_SEPARATORS = re.compile('[ \n\t\v\f\r\0]+')
+_UINT32_MASK = 0xFFFFFFFF
+_UINT64_MASK = 0xFFFFFFFFFFFFFFFF
+# the ids of a token take about 1KB with subwords, so this takes ~16MB
+_TOKEN_IDS_CACHE_SIZE = 2 ** 14
+
+# fasttext computes sigmoids through a lookup table
+MAX_SIGMOID = 8
+SIGMOID_TABLE_SIZE = 512
+_SIGMOID_TABLE = (1 / (1 + np.exp(-(
+    np.arange(SIGMOID_TABLE_SIZE + 1) * 2 * MAX_SIGMOID / SIGMOID_TABLE_SIZE
+    - MAX_SIGMOID)))).astype(np.float32)
+
+
+def _table_sigmoid(x):
+    ix = ((x + MAX_SIGMOID) * (SIGMOID_TABLE_SIZE / MAX_SIGMOID / 2)).astype(
+        np.intp)
+    sigmoid = _SIGMOID_TABLE[np.clip(ix, 0, SIGMOID_TABLE_SIZE)]
+    sigmoid[x < -MAX_SIGMOID] = 0
+    sigmoid[x > MAX_SIGMOID] = 1
+    return sigmoid
+
+
+def _fnv1a_hash(token_bytes):
+    # fasttext sign-extends each byte before mixing it in
+    hash_ = 2166136261
+    for byte in token_bytes:
+        hash_ = ((hash_ ^ (byte | 0xFFFFFF00 if byte > 127 else byte))
+                 * 16777619) & _UINT32_MASK
+    return hash_
+
+
+def _push_heap(heap, hole, top, value):
+    # libstdc++'s std::__push_heap, with fasttext's comparePairs
+    parent = (hole - 1) // 2
+    while hole > top and heap[parent][0] > value[0]:
+        heap[hole] = heap[parent]
+        hole = parent
+        parent = (hole - 1) // 2
+    heap[hole] = value
+
+
+def _pop_heap(heap, last):
+    # libstdc++'s std::pop_heap over heap[:last], via std::__adjust_heap
+    value, heap[last - 1] = heap[last - 1], heap[0]
+    length, hole, child = last - 1, 0, 0
+    while child < (length - 1) // 2:
+        child = 2 * (child + 1)
+        if heap[child][0] > heap[child - 1][0]:
+            child -= 1
+        heap[hole] = heap[child]
+        hole = child
+    if length % 2 == 0 and child == (length - 2) // 2:
+        child = 2 * (child + 1)
+        heap[hole] = heap[child - 1]
+        hole = child - 1
+    _push_heap(heap, hole, 0, value)
+
+
+def _find_k_best(log_probas, probas, k, threshold):
+    """Returns the label indices fasttext's findKBest would, in order.
+
+    Replays fasttext's heap operations exactly, so labels of equal
+    probability are ordered the same way fasttext orders them.
+    """
+    heap = []
+    for i, (log_proba, proba) in enumerate(zip(log_probas, probas)):
+        if proba < threshold:
+            continue
+        if len(heap) == k and log_proba < heap[0][0]:
+            continue
+        heap.append((log_proba, i))
+        _push_heap(heap, len(heap) - 1, 0, heap[-1])
+        if len(heap) > k:
+            _pop_heap(heap, len(heap))
+            heap.pop()
+    for last in range(len(heap), 1, -1):  # std::sort_heap
+        _pop_heap(heap, last)
+    return [i for _, i in heap]
+
+
+def _has_top_k_ties(log_probas, k):
+    top = np.sort(log_probas)[::-1]
+    candidates = top[top >= top[k - 1]]
+    return len(np.unique(candidates)) < len(candidates)
+
+
+def _word_index(encoded_words):
+    # sorted (hash << 32 | id) keys, so word ids are found by binary search
+    keys = np.fromiter(
+        (_fnv1a_hash(word) << 32 | i
+         for i, word in enumerate(encoded_words)),
+        dtype=np.uint64, count=len(encoded_words))
+    keys.sort()
+    return keys
+
+
+def _export_words(words, dirpath):
+    # one UTF-8 buffer and offsets into it, rather than per-process strs
+    encoded_words = [word.encode('utf-8') for word in words]
+    offsets = np.zeros(len(encoded_words) + 1, dtype=np.int64)
+    np.cumsum([len(word) for word in encoded_words], out=offsets[1:])
+    np.save(os.path.join(dirpath, WORDS_FNAME), np.frombuffer(
+        b''.join(encoded_words), dtype=np.uint8))
+    np.save(os.path.join(dirpath, WORD_OFFSETS_FNAME), offsets)
+    np.save(
+        os.path.join(dirpath, WORD_INDEX_FNAME), _word_index(encoded_words))
+
+
+def export_fasttext_model(model, dirpath):
+    """Exports a supervised fasttext model to an mmap-friendly directory.
+
+    Parameters
+    ----------
+    model : fasttext.FastText._FastText
+        A trained, non-quantized, supervised fasttext model.
+    dirpath : str
+        The directory to export the model to. Created if it does not exist.
+    """
+    if model.is_quantized():
+        raise ValueError("Quantized models can not be memory-mapped.")
+    args = model.f.getArgs()
+    if args.loss.name not in SUPPORTED_LOSSES:
+        raise ValueError(
+            "Memory-mapped models support the {} losses, not '{}'.".format(
+                ', '.join(SUPPORTED_LOSSES), args.loss.name))
+    os.makedirs(dirpath, exist_ok=True)
+    np.save(
+        os.path.join(dirpath, INPUT_MATRIX_FNAME), model.get_input_matrix())
+    np.save(
+        os.path.join(dirpath, OUTPUT_MATRIX_FNAME),
+        model.get_output_matrix())
+    dictionary = {
+        'labels': model.labels,
+        'args': {
+            'minn': args.minn,
+            'maxn': args.maxn,
+            'bucket': args.bucket,
+            'wordNgrams': args.wordNgrams,
+            'loss': args.loss.name,
+            'label': args.label,
+        },
+    }
+    with open(os.path.join(dirpath, DICTIONARY_FNAME), 'w',
+              encoding='utf-8') as wfile:
+        json.dump(dictionary, wfile, ensure_ascii=False)
+    _export_words(model.words, dirpath)
+
+
+class MmapFastTextModel:
+    """A read-only supervised fasttext model over memory-mapped matrices.
+
+    Implements the parts of the fasttext model interface skift classifiers
+    use for inference: predict, get_labels and is_quantized. Pickling it
+    only pickles the directory path.
+
+    Parameters
+    ----------
+    dirpath : str
+        A directory a model was exported to by export_fasttext_model.
+    """
+
+    def __init__(self, dirpath):
+        # pickled as is, so must not depend on the working directory
+        dirpath = os.path.abspath(dirpath)
+        self.dirpath = dirpath
+        with open(os.path.join(dirpath, DICTIONARY_FNAME),
+                  encoding='utf-8') as rfile:
+            dictionary = json.load(rfile)
+        self.labels = dictionary['labels']
+        self.args = dictionary['args']
+        self.input_matrix = np.load(
+            os.path.join(dirpath, INPUT_MATRIX_FNAME), mmap_mode='r')
+        self.output_matrix = np.load(
+            os.path.join(dirpath, OUTPUT_MATRIX_FNAME), mmap_mode='r')
+        # the vocabulary is mapped too, so it is shared between processes
+        self.word_bytes = np.load(
+            os.path.join(dirpath, WORDS_FNAME), mmap_mode='r')
+        self.word_offsets = np.load(
+            os.path.join(dirpath, WORD_OFFSETS_FNAME), mmap_mode='r')
+        self.word_index = np.load(
+            os.path.join(dirpath, WORD_INDEX_FNAME), mmap_mode='r')
+        self.n_words = len(self.word_offsets) - 1
+        self._token_ids = lru_cache(maxsize=_TOKEN_IDS_CACHE_SIZE)(
+            self._compute_token_ids)
+
+    def __reduce__(self):
+        return (self.__class__, (self.dirpath,))
+
+    @property
+    def words(self):
+        """The vocabulary, decoded anew from the mapped buffer on each use."""
+        return [self._word(i) for i in range(self.n_words)]
+
+    def _word_bytes(self, word_id):
+        start, stop = self.word_offsets[word_id:word_id + 2]
+        return self.word_bytes[start:stop].tobytes()
+
+    def _word(self, word_id):
+        return self._word_bytes(word_id).decode('utf-8')
+
+    def get_labels(self):
+        return list(self.labels)
+
+    def get_dimension(self):
+        return self.input_matrix.shape[1]
+
+    def is_quantized(self):
+        return False
+
+    def quantize(self, **kwargs):
+        raise ValueError("Memory-mapped models are read-only.")
+
+    def save_model(self, path):
+        raise ValueError(
+            "Memory-mapped models can not be saved in fasttext format.")
+
+    def _subword_ids(self, token):
+        # mirrors Dictionary::computeSubwords
+        minn, maxn = self.args['minn'], self.args['maxn']
+        bucket, nwords = self.args['bucket'], self.n_words
+        word = (BOW + token + EOW).encode('utf-8')
+        ids = []
+        for i in range(len(word)):
+            if (word[i] & 0xC0) == 0x80:  # inside a multi-byte character
+                continue
+            j, n = i, 1
+            while j < len(word) and n <= maxn:
+                j += 1
+                while j < len(word) and (word[j] & 0xC0) == 0x80:
+                    j += 1
+                if n >= minn and not (n == 1 and (i == 0 or j == len(word))):
+                    ids.append(nwords + _fnv1a_hash(word[i:j]) % bucket)
+                n += 1
+        return ids
+
+    def _word_id(self, token):
+        token_bytes = token.encode('utf-8')
+        hash_ = _fnv1a_hash(token_bytes)
+        i = int(np.searchsorted(self.word_index, np.uint64(hash_ << 32)))
+        while i < len(self.word_index):
+            key = int(self.word_index[i])
+            if key >> 32 != hash_:
+                break
+            if self._word_bytes(key & _UINT32_MASK) == token_bytes:
+                return key & _UINT32_MASK
+            i += 1
+        return -1
+
+    def _compute_token_ids(self, token):
+        word_id = self._word_id(token)
+        ids = [word_id] if word_id >= 0 else []
+        if token != EOS:
+            ids.extend(self._subword_ids(token))
+        return tuple(ids)
+
+    def _line_ids(self, text):
+        # mirrors Dictionary::getLine and Dictionary::addWordNgrams
+        ids = []
+        hashes = []
+        for token in _TOKEN_SEPARATORS.split(text) + [EOS]:
+            if not token or token.startswith(self.args['label']):
+                continue
+            ids.extend(self._token_ids(token))
+            hash_ = _fnv1a_hash(token.encode('utf-8'))
+            # fasttext keeps word hashes as signed 32 bit integers
+            hashes.append(hash_ - (1 << 32) if hash_ > 0x7FFFFFFF else hash_)
+        bucket, nwords = self.args['bucket'], self.n_words
+        n_grams = self.args['wordNgrams']
+        for i in range(len(hashes)):
+            hash_ = hashes[i] & _UINT64_MASK
+            for j in range(i + 1, min(i + n_grams, len(hashes))):
+                hash_ = (hash_ * 116049371 + hashes[j]) & _UINT64_MASK
+                ids.append(nwords + hash_ % bucket)
+        return ids
+
+    def predict_proba(self, texts):
+        """Returns the label probabilities of each of the given texts.
+
+        Parameters
+        ----------
+        texts : list of str
+            Single lines of text.
+
+        Returns
+        -------
+        probas : numpy.ndarray of float32, shape = [n_texts, n_labels]
+            The probability of each label, in the order of labels.
+        """
+        line_ids = [self._line_ids(text) for text in texts]
+        counts = np.fromiter(
+            (len(ids) for ids in line_ids), dtype=np.intp,
+            count=len(line_ids))
+        rows = self.input_matrix[np.fromiter(
+            (id_ for ids in line_ids for id_ in ids), dtype=np.intp,
+            count=counts.sum())]
+        offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        # like fasttext, sums rows in float32 and multiplies by 1 / count
+        hidden = np.add.reduceat(rows, offsets, axis=0) * (
+            1 / counts[:, None]).astype(np.float32)
+        output = hidden @ self.output_matrix.T
+        if self.args['loss'] == 'softmax':
+            output = np.exp(output - output.max(axis=1, keepdims=True))
+            return output / output.sum(axis=1, keepdims=True)
+        return _table_sigmoid(output)
+
+    def predict(self, text, k=1, threshold=0.0, on_unicode_error='strict'):
+        """Returns the k most likely labels of text, and their probabilities.
+
+        Behaves like the predict method of fasttext models: text can be a
+        single line of text or a list of them, and labels with a probability
+        below threshold are left out.
+        """
+        texts = [text] if isinstance(text, str) else text
+        if any('\n' in entry for entry in texts):
+            raise ValueError(
+                "predict processes one line at a time (remove '\\n')")
+        all_labels, all_probs = [], []
+        if len(texts):
+            probas = self.predict_proba(texts)
+            if k <= 0 or k > probas.shape[1]:
+                k = probas.shape[1]
+            # fasttext ranks labels by log(p + 1e-5), and reports its exp
+            log_probas = np.log(probas + np.float32(1e-5))
+            order = np.argsort(-log_probas, axis=1, kind='stable')[:, :k]
+            for row, row_order in enumerate(order):
+                if _has_top_k_ties(log_probas[row], k):
+                    row_order = _find_k_best(
+                        log_probas[row], probas[row], k, threshold)
+                else:
+                    row_order = row_order[probas[row, row_order] >= threshold]
+                all_labels.append([self.labels[i] for i in row_order])
+                all_probs.append(np.exp(log_probas[row, row_order]))
+        if isinstance(text, str):
+            return tuple(all_labels[0]), all_probs[0].astype(np.float64)
+        return all_labels, all_probs
+
+
+def save_mmap_classifier(clf, dirpath):
+    """Saves a fitted skift classifier to an mmap-friendly directory.
+
+    Parameters
+    ----------
+    clf : skift.core.FtClassifierABC
+        A fitted skift classifier, with a non-quantized model.
+    dirpath : str
+        The directory to save the classifier to.
+    """
+    export_fasttext_model(clf.model, dirpath)
+    estimator = clf.__class__.__new__(clf.__class__)
+    estimator.__dict__.update(clf.__dict__)
+    estimator.model = None
+    with open(os.path.join(dirpath, ESTIMATOR_FNAME), 'wb') as wfile:
+        pickle.dump(estimator, wfile)
+
+
+def load_mmap_classifier(dirpath):
+    """Loads a skift classifier saved by save_mmap_classifier.
+
+    Its model matrices are memory-mapped read-only, so processes loading
+    the same directory share their memory.
+
+    Parameters
+    ----------
+    dirpath : str
+        The directory the classifier was saved to.
+
+    Returns
+    -------
+    clf : skift.core.FtClassifierABC
+        The loaded classifier.
+    """
+    with open(os.path.join(dirpath, ESTIMATOR_FNAME), 'rb') as rfile:
+        clf = pickle.load(rfile)
+    clf.model = MmapFastTextModel(dirpath)
+    return clf
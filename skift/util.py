@@ -1,11 +1,37 @@
 """fasttext-related utilities."""
 
 import os
-from random import randint
+import re
+import errno
+import atexit
+import hashlib
+import logging
+import shutil
+import multiprocessing
+import tempfile
+import threading
+from stat import S_ISDIR
+from contextlib import contextmanager
+from itertools import islice
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 from fasttext import load_model
 
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
 SKIFT_TEMP_DIR_ENV_VAR = "SKIFT_TEMP_DIR"
+SKIFT_DATASET_CACHE_ENV_VAR = "SKIFT_DATASET_CACHE_MB"
+SKIFT_DUMP_N_JOBS_ENV_VAR = "SKIFT_DUMP_N_JOBS"
+SKIFT_RAM_TEMP_DIR_ENV_VAR = "SKIFT_RAM_TEMP_DIR"
+SKIFT_RAM_BUDGET_ENV_VAR = "SKIFT_RAM_BUDGET_MB"
+SKIFT_LAZY_LOAD_ENV_VAR = "SKIFT_LAZY_LOAD"
+
+logger = logging.getLogger(__name__)
 
 
 def get_temp_dir_name():
@@ -28,9 +54,349 @@ def get_temp_dir_name():
     return get_temp_dir_name.dir_name
 
 
-def temp_dataset_fpath():
-    temp_fname = 'temp_ft_trainset_{}.ft'.format(randint(1, 99999))
-    return os.path.join(get_temp_dir_name(), temp_fname)
+TEMP_FILE_PREFIX = 'temp_ft_'
+_TEMP_FNAME_PATTERN = re.compile(
+    r'^' + TEMP_FILE_PREFIX + r'[a-z]+_(\d+)_.*\.ft$')
+_TEMP_FILES_LOCK = threading.Lock()
+_STAGING_LOCK = threading.Lock()
+# path -> (pid of the creating process, tier, bytes reserved in RAM)
+_LIVE_TEMP_FILES = {}
+_TEMP_FILE_LOCK_FDS = {}  # path -> fd holding the flock of a live file
+_ORPHANS_SWEPT = set()  # temp dirs swept by this process
+
+
+def _try_lock(fd):
+    """Takes a non-blocking exclusive flock on fd; False if it is taken."""
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+
+def sweep_orphaned_temp_files(dir_name=None):
+    """Removes temp files left behind by skift processes that have died.
+
+    Every live skift temp file is held under an exclusive flock by the
+    process that created it, which the kernel releases when that process
+    dies, so files that can be locked are orphans. This also holds for
+    processes in other containers, or on other hosts sharing the directory
+    over NFS. This is done automatically, once per process and directory,
+    before the first temp file is created there. On platforms without
+    flock, like Windows, nothing is swept.
+
+    Parameters
+    ----------
+    dir_name : str, optional
+        The directory to sweep. Defaults to the skift temp directory.
+
+    Returns
+    -------
+    removed : list of str
+        The paths of the removed files.
+    """
+    if fcntl is None:  # pragma: no cover
+        return []
+    if dir_name is None:
+        dir_name = get_temp_dir_name()
+    removed = []
+    for entry in os.scandir(dir_name):
+        if not _TEMP_FNAME_PATTERN.match(entry.name):
+            continue
+        try:
+            fd = os.open(entry.path, os.O_RDONLY)
+        except FileNotFoundError:  # pragma: no cover
+            continue
+        try:
+            if _try_lock(fd):
+                os.remove(entry.path)
+                removed.append(entry.path)
+        except FileNotFoundError:  # pragma: no cover
+            pass
+        finally:
+            os.close(fd)
+    return removed
+
+
+RAM_TIER = 'ram'
+DISK_TIER = 'disk'
+
+
+_FALLBACK_DIRS = {}  # path -> (pid of the creating process, mkdtemp dir)
+
+
+def _is_private_dir(dir_name):
+    if not hasattr(os, 'getuid'):  # pragma: no cover
+        return os.path.isdir(dir_name)
+    stat = os.lstat(dir_name)
+    return (
+        S_ISDIR(stat.st_mode) and stat.st_uid == os.getuid()
+        and not stat.st_mode & 0o077)
+
+
+def private_user_dir(base_dir, name):
+    """Returns a directory in base_dir only the current user can access.
+
+    This is base_dir/name, shared by all processes of the current user, if
+    it is a real directory owned by the user, with no group or other
+    permissions. As names in shared folders like /tmp or /dev/shm can be
+    taken by other users first, to read or replace the files skift puts
+    there, a private mkdtemp directory, removed at exit, is used otherwise.
+
+    Parameters
+    ----------
+    base_dir : str
+        The folder to create the directory in.
+    name : str
+        The name of the directory.
+
+    Returns
+    -------
+    dir_name : str
+        The path of the directory.
+    """
+    dir_name = os.path.join(base_dir, name)
+    try:
+        os.makedirs(dir_name, mode=0o700, exist_ok=True)
+        if _is_private_dir(dir_name):
+            return dir_name
+    except OSError:  # e.g. a file, or a dangling link, by that name
+        pass
+    pid = os.getpid()
+    with _TEMP_FILES_LOCK:
+        owner, fallback_dir = _FALLBACK_DIRS.get(dir_name, (None, None))
+        if owner != pid:
+            logger.warning(
+                "%s is not a private directory of the current user; using "
+                "a per-process directory instead.", dir_name)
+            fallback_dir = tempfile.mkdtemp(prefix=name + '-', dir=base_dir)
+            _FALLBACK_DIRS[dir_name] = (pid, fallback_dir)
+    return fallback_dir
+
+
+@atexit.register
+def _remove_fallback_dirs():
+    pid = os.getpid()
+    with _TEMP_FILES_LOCK:
+        own_dirs = [
+            dir_name for dir_name, (owner, _) in _FALLBACK_DIRS.items()
+            if owner == pid]
+        fallback_dirs = [_FALLBACK_DIRS.pop(d)[1] for d in own_dirs]
+    for fallback_dir in fallback_dirs:
+        shutil.rmtree(fallback_dir, ignore_errors=True)
+
+
+def get_ram_temp_dir_name():
+    """Returns a skift directory on a RAM-backed filesystem, if there is one.
+
+    The directory is created in the folder given by the SKIFT_RAM_TEMP_DIR
+    environment variable, or in /dev/shm by default.
+
+    Returns
+    -------
+    dir_name : str or None
+        The path of the directory, or None if no RAM-backed folder exists.
+    """
+    base_dir = os.getenv(SKIFT_RAM_TEMP_DIR_ENV_VAR, '/dev/shm')
+    if not os.path.isdir(base_dir) or not os.access(base_dir, os.W_OK):
+        return None
+    # shared by all processes of the same user, so orphans can be swept
+    return private_user_dir(base_dir, 'skift-{}'.format(
+        getattr(os, 'getuid', lambda: 0)()))
+
+
+def _read_int(fpath):
+    try:
+        with open(fpath) as rfile:
+            return int(rfile.read().strip())
+    except (OSError, ValueError):  # missing, or 'max' for no limit
+        return None
+
+
+def get_available_memory():
+    """Returns the memory available to this process, in bytes, if known.
+
+    This is the smallest of the MemAvailable field of /proc/meminfo and
+    the headroom left under the memory limit of the process' cgroup, v1
+    or v2, as files on RAM-backed filesystems count against both. Returns
+    None where neither is available, e.g. on other platforms than Linux.
+    """
+    candidates = []
+    try:
+        with open('/proc/meminfo') as rfile:
+            for line in rfile:
+                if line.startswith('MemAvailable:'):
+                    candidates.append(int(line.split()[1]) * 1024)
+    except OSError:  # pragma: no cover
+        pass
+    for limit_fname, usage_fname in [
+        ('memory.max', 'memory.current'),
+        ('memory/memory.limit_in_bytes', 'memory/memory.usage_in_bytes'),
+    ]:
+        limit = _read_int(os.path.join('/sys/fs/cgroup', limit_fname))
+        usage = _read_int(os.path.join('/sys/fs/cgroup', usage_fname))
+        if limit is not None and usage is not None:
+            candidates.append(max(limit - usage, 0))
+    return min(candidates) if candidates else None
+
+
+def get_ram_budget(ram_dir):
+    """Returns the total size, in bytes, of the files to stage in RAM.
+
+    This is the budget set, in megabytes, by the SKIFT_RAM_BUDGET_MB
+    environment variable, capped by the free space of the RAM-backed
+    directory and by the available memory; without it, half of the smaller
+    of the two is used. Setting it to 0 disables staging in RAM.
+    """
+    stat = os.statvfs(ram_dir)
+    free_bytes = stat.f_bavail * stat.f_frsize
+    available_memory = get_available_memory()
+    if available_memory is not None:
+        free_bytes = min(free_bytes, available_memory)
+    budget_mb = os.getenv(SKIFT_RAM_BUDGET_ENV_VAR)
+    if budget_mb is None:
+        return free_bytes // 2
+    return min(int(float(budget_mb) * 2 ** 20), free_bytes)
+
+
+def _ram_staged_bytes():
+    pid = os.getpid()
+    with _TEMP_FILES_LOCK:
+        return sum(
+            size for owner, tier, size in _LIVE_TEMP_FILES.values()
+            if owner == pid and tier == RAM_TIER)
+
+
+def _staging_dir(size_hint):
+    if size_hint is not None and hasattr(os, 'statvfs'):
+        ram_dir = get_ram_temp_dir_name()
+        # the expected sizes of files already staged by this process are
+        # reserved, so concurrent fits never overrun the budget together
+        if ram_dir is not None and size_hint <= get_ram_budget(
+                ram_dir) - _ram_staged_bytes():
+            return ram_dir, RAM_TIER
+    return get_temp_dir_name(), DISK_TIER
+
+
+def new_temp_fpath(kind, suffix='.ft', size_hint=None, dir_name=None):
+    """Atomically creates a new, empty and uniquely named skift temp file.
+
+    Files of a known expected size that fits within what is left of the
+    RAM budget are staged on a RAM-backed filesystem, like /dev/shm; all
+    others in the skift temp directory. The file is registered for removal
+    when the interpreter exits; use remove_temp_file or the temp_file
+    context manager to remove it sooner.
+
+    Parameters
+    ----------
+    kind : str
+        The kind of the temp file, e.g. 'trainset' or 'model'.
+    suffix : str, default '.ft'
+        The suffix of the file name.
+    size_hint : int, optional
+        The expected size of the file, in bytes. If not given, the file is
+        never staged in RAM.
+    dir_name : str, optional
+        The directory to create the file in, overriding the staging policy.
+
+    Returns
+    -------
+    filepath : str
+        The path of the created file.
+    """
+    pid = os.getpid()
+    # staged and registered atomically, so the RAM budget is never overrun
+    with _STAGING_LOCK:
+        if dir_name is None:
+            dir_name, tier = _staging_dir(size_hint)
+        else:
+            tier = DISK_TIER
+        if (pid, dir_name) not in _ORPHANS_SWEPT:
+            _ORPHANS_SWEPT.add((pid, dir_name))
+            sweep_orphaned_temp_files(dir_name)
+        while True:
+            fd, filepath = tempfile.mkstemp(
+                suffix=suffix, dir=dir_name,
+                prefix='{}{}_{}_'.format(TEMP_FILE_PREFIX, kind, pid))
+            if fcntl is None:  # pragma: no cover
+                os.close(fd)
+                break
+            # a concurrent sweep may take the file before it is locked
+            if _try_lock(fd) and os.fstat(fd).st_nlink:
+                break
+            os.close(fd)  # pragma: no cover
+        reserved = size_hint if tier == RAM_TIER else 0
+        with _TEMP_FILES_LOCK:
+            _LIVE_TEMP_FILES[filepath] = (pid, tier, reserved)
+            if fcntl is not None:
+                _TEMP_FILE_LOCK_FDS[filepath] = fd
+    logger.debug(
+        "Staging %s temp file %s in %s (%s tier).", kind,
+        os.path.basename(filepath), dir_name, tier)
+    return filepath
+
+
+def staging_tier(filepath):
+    """Returns the storage tier, 'ram' or 'disk', of a live skift temp file.
+
+    Returns None if the file is not a live skift temp file.
+    """
+    with _TEMP_FILES_LOCK:
+        _, tier, _ = _LIVE_TEMP_FILES.get(filepath, (None, None, 0))
+    return tier
+
+
+def _forget_temp_file(filepath):
+    with _TEMP_FILES_LOCK:
+        _LIVE_TEMP_FILES.pop(filepath, None)
+        fd = _TEMP_FILE_LOCK_FDS.pop(filepath, None)
+    if fd is not None:
+        os.close(fd)
+
+
+def remove_temp_file(filepath):
+    """Removes a skift temp file, if it exists, and unregisters it."""
+    try:
+        os.remove(filepath)
+    except FileNotFoundError:
+        pass
+    _forget_temp_file(filepath)
+
+
+@contextmanager
+def temp_file(kind, size_hint=None):
+    """A context manager yielding a new skift temp file path.
+
+    The file is removed on exit, also if an exception is raised.
+
+    Parameters
+    ----------
+    kind : str
+        The kind of the temp file, e.g. 'trainset' or 'model'.
+    size_hint : int, optional
+        The expected size of the file, in bytes; see new_temp_fpath.
+    """
+    filepath = new_temp_fpath(kind, size_hint=size_hint)
+    try:
+        yield filepath
+    finally:
+        remove_temp_file(filepath)
+
+
+@atexit.register
+def _remove_live_temp_files():
+    pid = os.getpid()
+    with _TEMP_FILES_LOCK:
+        # forked children inherit the registry, but not the files
+        own_files = [
+            fpath for fpath, (owner, _, _) in _LIVE_TEMP_FILES.items()
+            if owner == pid]
+    for fpath in own_files:
+        remove_temp_file(fpath)
+
+
+def temp_dataset_fpath(size_hint=None):
+    return new_temp_fpath('trainset', size_hint=size_hint)
 
 
 # def dump_df_to_fasttext_format(df, filepath, label_field, text_field):
@@ -53,9 +419,252 @@ def temp_dataset_fpath():
 #                 row[1][label_field], row[1][text_field]))
 
 
-def dump_xy_to_fasttext_format(X, y, filepath):
+# number of rows formatted and written to a fasttext file at a time
+DUMP_CHUNK_SIZE = 100000
+# size, in bytes, of the write buffer of fasttext-format files
+DUMP_BUFFER_SIZE = 2 ** 24
+
+
+def _iter_list_chunks(arr, chunk_size):
+    """Yields consecutive lists of at most chunk_size items of arr.
+
+    Arrays and Series are sliced and converted in bulk; other iterables are
+    consumed item by item.
+    """
+    if hasattr(arr, 'tolist') and hasattr(arr, '__len__'):
+        sliceable = getattr(arr, 'iloc', arr)
+        for start in range(0, len(arr), chunk_size):
+            yield sliceable[start:start + chunk_size].tolist()
+        return
+    if hasattr(arr, 'to_pylist'):  # pyarrow Array or ChunkedArray
+        for start in range(0, len(arr), chunk_size):
+            yield arr.slice(start, chunk_size).to_pylist()
+        return
+    iterator = iter(arr)
+    chunk = list(islice(iterator, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, chunk_size))
+
+
+def _format_fasttext_lines(texts, labels):
+    """Formats texts and their labels into one fasttext-format string."""
+    uniques, inverse = np.unique(labels, return_inverse=True)
+    prefixes = np.array(
+        ['__label__{} '.format(label) for label in uniques], dtype=object)
+    # interleave label prefixes, texts and newlines for a single join
+    parts = [None] * (3 * len(texts))
+    parts[0::3] = prefixes[inverse].tolist()
+    parts[1::3] = texts
+    parts[2::3] = ['\n'] * len(texts)
+    try:
+        return ''.join(parts)
+    except TypeError:  # non-string texts
+        parts[1::3] = map(str, texts)
+        return ''.join(parts)
+
+
+def _write_xy(wfile, X, y, chunk_size):
+    y = np.asarray(y)
+    start = 0
+    for texts in _iter_list_chunks(X, chunk_size):
+        labels = y[start:start + len(texts)]
+        wfile.write(_format_fasttext_lines(texts, labels).encode('utf-8'))
+        start += len(texts)
+
+
+def _no_space_hint(filepath):
+    if staging_tier(filepath) == RAM_TIER:
+        return (
+            " Lower the {} environment variable, or set it to 0 to never "
+            "stage training sets in RAM.").format(SKIFT_RAM_BUDGET_ENV_VAR)
+    return (
+        " Set the {} environment variable to a directory on a larger "
+        "volume.").format(SKIFT_TEMP_DIR_ENV_VAR)
+
+
+def _dump_to_file(filepath, write):
+    try:
+        with open(filepath, 'wb', buffering=DUMP_BUFFER_SIZE) as wfile:
+            return write(wfile)
+    except OSError as err:
+        # never leave a partial, possibly huge, dump behind
+        try:
+            os.remove(filepath)
+        except FileNotFoundError:
+            pass
+        if err.errno == errno.ENOSPC:
+            raise OSError(errno.ENOSPC, (
+                "Not enough space to dump a fasttext training set to {}."
+                "{}").format(filepath, _no_space_hint(filepath))) from err
+        raise
+
+
+def dump_xy_to_fasttext_format(X, y, filepath, chunk_size=DUMP_CHUNK_SIZE):
     """Dumps the given X and y matrices  to a fasttext-compatible csv file.
 
+    Rows are formatted in chunks, each encoded once and written through a
+    large buffer.
+
+    Parameters
+    ----------
+    X : array-like, shape = [n_samples]
+        The input samples. An array of strings.
+    y : array-like, shape = [n_samples]
+        The target values. An array of int.
+    filepath : str
+        The fully qualified path to the file to dump.
+    chunk_size : int, default DUMP_CHUNK_SIZE
+        The number of rows formatted at a time.
+    """
+    _dump_to_file(filepath, lambda wfile: _write_xy(wfile, X, y, chunk_size))
+
+
+def dump_xy_chunks_to_fasttext_format(
+        chunks, filepath, chunk_size=DUMP_CHUNK_SIZE):
+    """Dumps an iterable of (X, y) chunks to a fasttext-compatible file.
+
+    Chunks are consumed and appended to the file one at a time, so the
+    whole dataset never has to fit in memory.
+
+    Parameters
+    ----------
+    chunks : iterable of (array-like, array-like) pairs
+        Pairs of input samples, an array of strings, and their target
+        values.
+    filepath : str
+        The fully qualified path to the file to dump.
+    chunk_size : int, default DUMP_CHUNK_SIZE
+        The number of rows formatted at a time.
+
+    Returns
+    -------
+    labels : set
+        The distinct target values seen across all chunks.
+    """
+    def write(wfile):
+        seen_labels = set()
+        for X, y in chunks:
+            y = np.asarray(y)
+            seen_labels.update(np.unique(y).tolist())
+            _write_xy(wfile, X, y, chunk_size)
+        return seen_labels
+
+    return _dump_to_file(filepath, write)
+
+
+PARALLEL_DUMP_MIN_ROWS = 2000000
+_DUMP_WORKER_STATE = {}
+
+
+def _row_range(arr, start, stop):
+    if hasattr(arr, 'to_pylist'):  # pyarrow Array or ChunkedArray
+        return arr.slice(start, stop - start)
+    return getattr(arr, 'iloc', arr)[start:stop]
+
+
+def _init_dump_worker(X, y):
+    # X and y are inherited through fork, and never pickled
+    _DUMP_WORKER_STATE['X'] = X
+    _DUMP_WORKER_STATE['y'] = y
+
+
+def _dump_shard_in_worker(start, stop, shard_fpath, chunk_size):
+    X, y = _DUMP_WORKER_STATE['X'], _DUMP_WORKER_STATE['y']
+    with open(shard_fpath, 'wb', buffering=DUMP_BUFFER_SIZE) as wfile:
+        _write_xy(wfile, _row_range(X, start, stop), y[start:stop], chunk_size)
+
+
+def _append_file(rfile, wfile):
+    wfile.flush()
+    if hasattr(os, 'copy_file_range'):
+        # copied by the kernel, without passing through user space
+        try:
+            while os.copy_file_range(
+                    rfile.fileno(), wfile.fileno(), DUMP_BUFFER_SIZE):
+                pass
+            return
+        except OSError as err:
+            if err.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL):
+                raise
+    shutil.copyfileobj(rfile, wfile, DUMP_BUFFER_SIZE)
+
+
+def dump_xy_to_fasttext_format_parallel(
+        X, y, filepath, n_jobs=None, chunk_size=DUMP_CHUNK_SIZE):
+    """Dumps X and y to a fasttext-compatible file using worker processes.
+
+    X is split into one disjoint row range per worker. Forked worker
+    processes inherit X and y, so only row ranges are sent to them; each
+    formats its range into a shard file next to filepath, and the shards
+    are then concatenated into filepath, by the kernel where supported.
+    Where processes can not be forked, or X is empty or can not be sliced,
+    X is dumped by dump_xy_to_fasttext_format instead.
+
+    Parameters
+    ----------
+    X : array-like, shape = [n_samples]
+        The input samples. An array of strings.
+    y : array-like, shape = [n_samples]
+        The target values. An array of int.
+    filepath : str
+        The fully qualified path to the file to dump.
+    n_jobs : int, optional
+        The number of worker processes, at most one per row. Defaults to
+        the number of CPUs.
+    chunk_size : int, default DUMP_CHUNK_SIZE
+        The number of rows each worker formats at a time.
+    """
+    sliceable = hasattr(X, '__len__') and hasattr(X, '__getitem__')
+    if 'fork' not in multiprocessing.get_all_start_methods() or (
+            not sliceable) or len(X) == 0:
+        return dump_xy_to_fasttext_format(X, y, filepath, chunk_size)
+    n_jobs = min(n_jobs or os.cpu_count() or 1, len(X))
+    y = np.asarray(y)
+    shard_rows = -(-len(X) // n_jobs)  # ceiling division
+    bounds = [
+        (start, min(start + shard_rows, len(X)))
+        for start in range(0, len(X), shard_rows)]
+    dir_name = os.path.dirname(os.path.abspath(filepath))
+    shard_fpaths = [
+        new_temp_fpath('shard', dir_name=dir_name) for _ in bounds]
+
+    def write(wfile):
+        with ProcessPoolExecutor(
+            max_workers=len(bounds),
+            mp_context=multiprocessing.get_context('fork'),
+            initializer=_init_dump_worker,
+            initargs=(X, y),
+        ) as executor:
+            futures = [
+                executor.submit(
+                    _dump_shard_in_worker, start, stop, shard_fpath,
+                    chunk_size)
+                for (start, stop), shard_fpath in zip(bounds, shard_fpaths)]
+            for future in futures:
+                future.result()
+        for shard_fpath in shard_fpaths:
+            with open(shard_fpath, 'rb') as rfile:
+                _append_file(rfile, wfile)
+            remove_temp_file(shard_fpath)
+
+    try:
+        _dump_to_file(filepath, write)
+    finally:
+        for shard_fpath in shard_fpaths:
+            remove_temp_file(shard_fpath)
+
+
+def dump_xy(X, y, filepath):
+    """Dumps X and y to a fasttext-compatible file, optionally in parallel.
+
+    Parallel dumping is opt-in: if the SKIFT_DUMP_N_JOBS environment
+    variable is set to more than 1, inputs of at least
+    PARALLEL_DUMP_MIN_ROWS rows are dumped by
+    dump_xy_to_fasttext_format_parallel with that many worker processes.
+    Run benchmarks/bench_dump_xy.py to check it beats the serial writer on
+    your hardware first.
+
     Parameters
     ----------
     X : array-like, shape = [n_samples]
@@ -65,31 +674,422 @@ def dump_xy_to_fasttext_format(X, y, filepath):
     filepath : str
         The fully qualified path to the file to dump.
     """
-    with open(filepath, 'w+', encoding='utf-8') as wfile:
-        for text, label in zip(X, y):
-            wfile.write('__label__{} {}\n'.format(label, text))
+    n_jobs = int(os.getenv(SKIFT_DUMP_N_JOBS_ENV_VAR, 1))
+    large = hasattr(X, '__len__') and len(X) >= PARALLEL_DUMP_MIN_ROWS
+    if large and n_jobs > 1:
+        dump_xy_to_fasttext_format_parallel(X, y, filepath, n_jobs=n_jobs)
+    else:
+        dump_xy_to_fasttext_format(X, y, filepath)
+
+
+def fingerprint_xy(X, y, chunk_size=DUMP_CHUNK_SIZE):
+    """Returns a hex digest identifying the contents of X and y.
+
+    Parameters
+    ----------
+    X : array-like, shape = [n_samples]
+        The input samples. An array of strings.
+    y : array-like, shape = [n_samples]
+        The target values.
+    chunk_size : int, default DUMP_CHUNK_SIZE
+        The number of texts hashed at a time.
+    """
+    hasher = hashlib.blake2b(digest_size=20)
+    y = np.asarray(y)
+    hasher.update(str(y.dtype).encode('utf-8'))
+    if y.dtype == object:
+        hasher.update('\x00'.join(map(str, y)).encode('utf-8'))
+    else:
+        hasher.update(np.ascontiguousarray(y).tobytes())
+    for texts in _iter_list_chunks(X, chunk_size):
+        try:
+            joined = '\x00'.join(texts)
+        except TypeError:  # non-string texts
+            joined = '\x00'.join(map(str, texts))
+        hasher.update(joined.encode('utf-8', 'surrogatepass'))
+        hasher.update(b'\x00')
+    return hasher.hexdigest()
+
+
+def get_dataset_cache_size():
+    """Returns the dataset cache size cap in bytes; 0 if it is disabled.
+
+    The cap is read, in megabytes, from the SKIFT_DATASET_CACHE_MB
+    environment variable.
+    """
+    return int(float(os.getenv(SKIFT_DATASET_CACHE_ENV_VAR, 0)) * 2 ** 20)
+
+
+def get_dataset_cache_dir():
+    """Returns the dataset cache directory, shared by all skift processes.
+
+    This is the dataset_cache sub-folder of the folder set by the
+    SKIFT_TEMP_DIR environment variable or, if it is not set, a per-user
+    skift-dataset-cache-<uid> folder in the system temp folder, checked by
+    private_user_dir to be accessible by the current user only. Unlike the
+    per-process temp folder, it is never removed automatically; use
+    clear_dataset_cache to remove it.
+    """
+    base_dir = os.getenv(SKIFT_TEMP_DIR_ENV_VAR)
+    if base_dir:
+        dir_name = os.path.join(base_dir, 'dataset_cache')
+        os.makedirs(dir_name, mode=0o700, exist_ok=True)
+        return dir_name
+    return private_user_dir(
+        tempfile.gettempdir(), 'skift-dataset-cache-{}'.format(
+            getattr(os, 'getuid', lambda: 0)()))
+
+
+def clear_dataset_cache():
+    """Removes the dataset cache directory and all dumps cached in it."""
+    shutil.rmtree(get_dataset_cache_dir(), ignore_errors=True)
+
+
+def _evict_from_dataset_cache(cache_dir, max_bytes, keep_fpath):
+    """Removes least recently used dumps until the cache fits max_bytes.
+
+    Dumps in use by a dataset_file context, in this or another process, are
+    held under a shared flock, and are never removed.
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        # dumps still being written by other processes are not evictable
+        if entry.name.endswith('.ft') and entry.path != keep_fpath and (
+                not entry.name.startswith(TEMP_FILE_PREFIX)):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:  # evicted by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total_bytes = sum(entry[1] for entry in entries)
+    total_bytes += os.path.getsize(keep_fpath)
+    for _, size, fpath in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        if _remove_unused_dump(fpath):
+            total_bytes -= size
+
+
+def _remove_unused_dump(fpath):
+    try:
+        fd = os.open(fpath, os.O_RDONLY)
+    except FileNotFoundError:  # evicted by another process
+        return True
+    try:
+        # fasttext reopens its input during training, so dumps in use stay
+        if fcntl is not None and not _try_lock(fd):
+            return False
+        os.remove(fpath)
+    except FileNotFoundError:  # pragma: no cover
+        pass
+    finally:
+        os.close(fd)
+    return True
+
+
+def _lock_cached_dump(fpath):
+    """Returns an fd holding a shared flock on a cached dump, if it exists."""
+    try:
+        fd = os.open(fpath, os.O_RDONLY)
+    except FileNotFoundError:  # evicted by another process
+        return None
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        # evicted between opening and locking it
+        if not os.fstat(fd).st_nlink:
+            os.close(fd)
+            return None
+    return fd
+
+
+def estimate_dump_size(X, y, sample_size=1000):
+    """Estimates the size, in bytes, of the fasttext dump of X and y.
+
+    The estimate is extrapolated from about sample_size rows, evenly spread
+    over X, so sorted or grouped inputs are not misjudged by their first
+    rows. Returns None if the number of rows is not known in advance.
+    """
+    if not hasattr(X, '__len__') or len(X) == 0:
+        return None
+    step = max(len(X) // sample_size, 1)
+    if hasattr(X, 'to_pylist'):  # pyarrow Array or ChunkedArray
+        texts = X.take(np.arange(0, len(X), step)).to_pylist()
+    else:
+        texts = list(getattr(X, 'iloc', X)[::step])
+    labels = np.asarray(y)[::step]
+    sample = _format_fasttext_lines(texts, labels).encode('utf-8')
+    return len(sample) * len(X) // len(texts)
+
+
+def _dump_xy_or_remove(X, y, filepath):
+    try:
+        dump_xy(X, y, filepath)
+    except BaseException:
+        remove_temp_file(filepath)
+        raise
+
+
+def dump_xy_to_dataset_file(X, y):
+    """Dumps X and y to a fasttext-format file, reusing cached dumps.
+
+    If the dataset cache is enabled, by setting the SKIFT_DATASET_CACHE_MB
+    environment variable, dumps are stored under a fingerprint of X and y,
+    so identical datasets - e.g. the same cross-validation fold fitted by
+    many grid search candidates - are only dumped once. Least recently used
+    dumps are evicted to keep the cache within its size cap.
+
+    Parameters
+    ----------
+    X : array-like, shape = [n_samples]
+        The input samples. An array of strings.
+    y : array-like, shape = [n_samples]
+        The target values.
+
+    Returns
+    -------
+    filepath : str
+        The path of the fasttext-format file.
+    is_temp : bool
+        True if the file is not cached, and should be removed after use.
+    """
+    max_bytes = get_dataset_cache_size()
+    if max_bytes <= 0:
+        filepath = temp_dataset_fpath(estimate_dump_size(X, y))
+        tier = staging_tier(filepath)
+        try:
+            _dump_xy_or_remove(X, y, filepath)
+        except OSError as err:
+            if tier != RAM_TIER or err.errno != errno.ENOSPC:
+                raise
+            # the estimate fell short, or others filled the RAM-backed tier
+            logger.info(
+                "Out of RAM-backed space; dumping the training set to disk.")
+            filepath = new_temp_fpath(
+                'trainset', dir_name=get_temp_dir_name())
+            _dump_xy_or_remove(X, y, filepath)
+        return filepath, True
+    cache_dir = get_dataset_cache_dir()
+    filepath = os.path.join(cache_dir, fingerprint_xy(X, y) + '.ft')
+    try:
+        os.utime(filepath)  # mark as most recently used
+        return filepath, False
+    except FileNotFoundError:
+        pass
+    # dumped next to its final path, so it can be atomically renamed
+    temp_fpath = new_temp_fpath('trainset', dir_name=cache_dir)
+    _dump_xy_or_remove(X, y, temp_fpath)
+    if os.path.getsize(temp_fpath) > max_bytes:
+        return temp_fpath, True
+    # atomic, so concurrent fits never read a partially written dump
+    os.replace(temp_fpath, filepath)
+    _forget_temp_file(temp_fpath)
+    _evict_from_dataset_cache(cache_dir, max_bytes, filepath)
+    return filepath, False
+
+
+@contextmanager
+def dataset_file(X, y):
+    """A context manager yielding the path of a fasttext dump of X and y.
+
+    The dump is made by dump_xy_to_dataset_file, and is removed on exit,
+    also if an exception is raised, unless it is kept in the dataset cache;
+    cached dumps are held under a shared flock until then, so they are not
+    evicted while in use.
+
+    Parameters
+    ----------
+    X : array-like, shape = [n_samples]
+        The input samples. An array of strings.
+    y : array-like, shape = [n_samples]
+        The target values.
+    """
+    lock_fd = None
+    while lock_fd is None:
+        filepath, is_temp = dump_xy_to_dataset_file(X, y)
+        if is_temp:
+            break
+        lock_fd = _lock_cached_dump(filepath)  # None if just evicted
+    try:
+        yield filepath
+    finally:
+        if is_temp:
+            remove_temp_file(filepath)
+        else:
+            os.close(lock_fd)
 
 
 def temp_model_fpath():
-    temp_fname = 'temp_ft_model_{}.ft'.format(randint(1, 99999))
-    return os.path.join(get_temp_dir_name(), temp_fname)
+    return new_temp_fpath('model')
+
+
+def estimate_model_size(model):
+    """Estimates the size, in bytes, of a saved fasttext model.
+
+    This is the size of its input and output matrices, an upper bound for
+    quantized models, plus that of its dictionary and headers.
+    """
+    args = model.f.getArgs()
+    entries = model.words + model.labels
+    n_rows = len(entries) + args.bucket
+    # each dictionary entry is saved with a null byte, a count and a type
+    dict_size = sum(len(entry.encode('utf-8')) + 10 for entry in entries)
+    return 4 * n_rows * model.get_dimension() + dict_size + 1024
+
+
+def lazy_load_enabled():
+    """Returns True if unpickled models should only be loaded on first use.
+
+    Lazy loading is enabled by setting the SKIFT_LAZY_LOAD environment
+    variable to 1.
+    """
+    return os.getenv(SKIFT_LAZY_LOAD_ENV_VAR, '0').lower() in (
+        '1', 'true', 'yes')
+
+
+# anonymous, RAM-only files reopenable by path; Linux only
+MEMFD_SUPPORTED = hasattr(os, 'memfd_create') and os.path.isdir(
+    '/proc/self/fd')
+
+
+@contextmanager
+def memory_file(name):
+    """A context manager yielding a path to a new anonymous in-memory file.
+
+    The file is created with os.memfd_create, so it never touches
+    persistent storage, and is reachable through its /proc/self/fd path
+    until the context exits. Only supported where MEMFD_SUPPORTED is True.
+
+    Parameters
+    ----------
+    name : str
+        The name of the file, for debugging purposes only.
+    """
+    fd = os.memfd_create(name)
+    try:
+        yield '/proc/self/fd/{}'.format(fd)
+    finally:
+        os.close(fd)
+
+
+def _save_and_read_model(model, fpath):
+    model.save_model(fpath)
+    with open(fpath, 'rb') as bfile:
+        return bfile.read()
+
+
+def _write_and_load_model(bytes_obj, fpath):
+    with open(fpath, 'wb+') as bfile:
+        bfile.write(bytes_obj)
+    return load_model(fpath)
 
 
 def python_fasttext_model_to_bytes(model):
-    temp_fpath = temp_model_fpath()
-    model.save_model(temp_fpath)
-    with open(temp_fpath, 'rb') as bfile:
-        bytes_obj = bfile.read()
-    os.remove(temp_fpath)
-    return bytes_obj
+    if MEMFD_SUPPORTED:
+        with memory_file('skift_model') as fpath:
+            return _save_and_read_model(model, fpath)
+    with temp_file('model', estimate_model_size(model)) as fpath:
+        return _save_and_read_model(model, fpath)
 
 
 def bytes_to_python_fasttext_model(bytes_obj):
+    # bytes_obj can be any bytes-like object, e.g. a pickle out-of-band
+    # buffer, and is written as is, without copying it first
     if bytes_obj is None:
         return None
-    temp_fpath = temp_model_fpath()
-    with open(temp_fpath, 'wb+') as bfile:
-        bfile.write(bytes_obj)
-    model = load_model(temp_fpath)
-    os.remove(temp_fpath)
-    return model
+    bytes_obj = memoryview(bytes_obj)
+    if MEMFD_SUPPORTED:
+        with memory_file('skift_model') as fpath:
+            return _write_and_load_model(bytes_obj, fpath)
+    with temp_file('model', bytes_obj.nbytes) as fpath:
+        return _write_and_load_model(bytes_obj, fpath)
+
+
+CacheInfo = namedtuple(
+    'CacheInfo', ['hits', 'misses', 'evictions', 'maxsize', 'currsize'])
+
+
+class PredictionCache:
+    """A thread-safe, size-bounded LRU cache of fasttext predict results.
+
+    Results are keyed on the (text, k, threshold) they were predicted for.
+    Pickled caches keep their maxsize but none of their entries.
+
+    Parameters
+    ----------
+    maxsize : int
+        The maximal number of results held; the least recently used result
+        is evicted when it is exceeded.
+    """
+
+    def __init__(self, maxsize):
+        if maxsize < 1:
+            raise ValueError("maxsize must be a positive integer.")
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self.clear()
+
+    def __getstate__(self):
+        return {'maxsize': self.maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(state['maxsize'])
+
+    def clear(self):
+        """Drops all cached results and resets the cache statistics."""
+        with self._lock:
+            self._results = OrderedDict()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def info(self):
+        """Returns a CacheInfo tuple of the cache statistics."""
+        with self._lock:
+            return CacheInfo(
+                self.hits, self.misses, self.evictions, self.maxsize,
+                len(self._results))
+
+    def predict(self, model, texts, k=1, threshold=0.0):
+        """Batched model.predict(texts, k), served from cache when possible.
+
+        Parameters
+        ----------
+        model : fasttext.FastText._FastText
+            The model used to predict texts missing from the cache.
+        texts : list of str
+            The texts to predict labels for.
+        k : int, default 1
+            The number of labels to predict for each text.
+        threshold : float, default 0.0
+            The minimal probability of predicted labels.
+
+        Returns
+        -------
+        labels, probs : list, list
+            The per-text labels and probabilities, as returned by fasttext.
+        """
+        results = [None] * len(texts)
+        missing = OrderedDict()
+        with self._lock:
+            for i, text in enumerate(texts):
+                key = (text, k, threshold)
+                try:
+                    results[i] = self._results[key]
+                except KeyError:
+                    missing.setdefault(text, []).append(i)
+                    self.misses += 1
+                else:
+                    self._results.move_to_end(key)
+                    self.hits += 1
+        if missing:
+            labels, probs = model.predict(list(missing), k, threshold)
+            with self._lock:
+                for text, result in zip(missing, zip(labels, probs)):
+                    for i in missing[text]:
+                        results[i] = result
+                    self._results[(text, k, threshold)] = result
+                    self._results.move_to_end((text, k, threshold))
+                while len(self._results) > self.maxsize:
+                    self._results.popitem(last=False)
+                    self.evictions += 1
+        return [res[0] for res in results], [res[1] for res in results]
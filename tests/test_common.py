@@ -1,7 +1,12 @@
 """Test common skift functionalities."""
 
+import os
+
 import pytest
+import numpy as np
 import pandas as pd
+from scipy.sparse import csr_matrix
+from sklearn.exceptions import NotFittedError
 from sklearn.model_selection import cross_val_score
 
 from skift import (
@@ -276,3 +281,781 @@ def test_get_temp_dir_environment():
         del os.environ[SKIFT_TEMP_DIR_ENV_VAR]
 
     shutil.rmtree(test_tempdir)
+
+
+def test_predict_chunked():
+    ftdf = _big_ftdf()
+    ft_clf = FirstColFtClassifier()
+    ft_clf.fit(ftdf[['txt']], ftdf['lbl'])
+
+    preds = ft_clf.predict(ftdf[['txt']])
+    assert len(preds) == len(ftdf)
+    assert (ft_clf.predict(ftdf[['txt']], chunk_size=3) == preds).all()
+    probas = ft_clf.predict_proba(ftdf[['txt']])
+    assert probas.shape == (len(ftdf), 2)
+    chunked_probas = ft_clf.predict_proba(ftdf[['txt']], chunk_size=3)
+    assert (chunked_probas == probas).all()
+    str_arr_probas = ft_clf.predict_proba_on_str_arr(
+        ftdf['txt'].values, chunk_size=1)
+    assert (str_arr_probas == probas).all()
+
+
+def test_predict_proba_class_order():
+    ftdf = pd.DataFrame(
+        data=[['moo moo', 2], ['woof woof', 0], ['meow meow', 1]],
+        columns=['txt', 'lbl']
+    )
+    ft_clf = FirstColFtClassifier(lr=1.0, epoch=100)
+    ft_clf.fit(ftdf[['txt']], ftdf['lbl'])
+
+    probas = ft_clf.predict_proba(ftdf[['txt']])
+    assert probas.shape == (3, 3)
+    assert (probas.argmax(axis=1) == [2, 0, 1]).all()
+    assert probas.sum(axis=1) == pytest.approx(1, abs=1e-3)
+
+
+def test_predict_n_jobs():
+    ftdf = _big_ftdf()
+    ft_clf = SeriesFtClassifier()
+    ft_clf.fit(ftdf['txt'], ftdf['lbl'])
+
+    preds = ft_clf.predict(ftdf['txt'])
+    assert (ft_clf.predict(ftdf['txt'], n_jobs=3) == preds).all()
+    assert (ft_clf.predict(ftdf['txt'], n_jobs=-1) == preds).all()
+    probas = ft_clf.predict_proba(ftdf['txt'])
+    sharded_probas = ft_clf.predict_proba(ftdf['txt'], n_jobs=3, chunk_size=2)
+    assert (sharded_probas == probas).all()
+    str_arr_probas = ft_clf.predict_proba_on_str_arr(
+        list(ftdf['txt']), n_jobs=20)
+    assert (str_arr_probas == probas).all()
+    with pytest.raises(ValueError):
+        ft_clf.predict(ftdf['txt'], n_jobs=0)
+
+
+def test_predict_process_pool():
+    ftdf = _big_ftdf()
+    ft_clf = FirstColFtClassifier()
+    ft_clf.fit(ftdf[['txt']], ftdf['lbl'])
+
+    preds = ft_clf.predict(ftdf[['txt']])
+    mp_preds = ft_clf.predict(
+        ftdf[['txt']], n_jobs=2, chunk_size=3, backend='multiprocessing')
+    assert (mp_preds == preds).all()
+    probas = ft_clf.predict_proba(ftdf[['txt']])
+    mp_probas = ft_clf.predict_proba(
+        ftdf[['txt']], n_jobs=2, chunk_size=3, backend='multiprocessing')
+    assert (mp_probas == probas).all()
+    with pytest.raises(ValueError):
+        ft_clf.predict(ftdf[['txt']], n_jobs=2, backend='dask')
+
+
+def test_prediction_cache():
+    ftdf = _big_ftdf()
+    ft_clf = FirstColFtClassifier()
+    assert ft_clf.prediction_cache_info() is None
+    ft_clf.set_prediction_cache(maxsize=4)
+    ft_clf.fit(ftdf[['txt']], ftdf['lbl'])
+
+    preds = ft_clf.predict([['woof'], ['meow'], ['woof']])
+    info = ft_clf.prediction_cache_info()
+    assert (info.hits, info.misses, info.currsize) == (0, 3, 2)
+    assert (ft_clf.predict([['woof'], ['meow']]) == preds[:2]).all()
+    assert ft_clf.prediction_cache_info().hits == 2
+
+    probas = ft_clf.predict_proba(ftdf[['txt']])
+    info = ft_clf.prediction_cache_info()
+    assert info.currsize == 4
+    assert info.evictions == 6
+    assert (ft_clf.predict_proba(ftdf[['txt']]) == probas).all()
+    assert (ft_clf.predict_proba_on_str_arr(ftdf['txt']) == probas).all()
+
+    ft_clf.fit(ftdf[['txt']], ftdf['lbl'])
+    assert ft_clf.prediction_cache_info().currsize == 0
+
+    ft_clf.set_prediction_cache(None)
+    assert ft_clf.prediction_cache_info() is None
+    with pytest.raises(ValueError):
+        ft_clf.set_prediction_cache(0)
+
+
+def test_predict_dedup():
+    ftdf = _big_ftdf()
+    ft_clf = SeriesFtClassifier()
+    ft_clf.fit(ftdf['txt'], ftdf['lbl'])
+
+    txt = pd.concat([ftdf['txt']] * 3, ignore_index=True)
+    preds = ft_clf.predict(txt)
+    assert (ft_clf.predict(txt, dedup=True) == preds).all()
+    probas = ft_clf.predict_proba(txt)
+    assert (ft_clf.predict_proba(txt, dedup=True, n_jobs=2) == probas).all()
+    assert (ft_clf.predict_proba_on_str_arr(
+        list(txt), dedup=True) == probas).all()
+
+    cat_txt = txt.astype('category')
+    assert (ft_clf.predict(cat_txt) == preds).all()
+    assert (ft_clf.predict_proba(cat_txt) == probas).all()
+    assert (ft_clf.predict_proba(cat_txt, dedup=False) == probas).all()
+    with pytest.raises(ValueError):
+        ft_clf.predict(pd.Series(['woof', None], dtype='category'))
+
+
+def test_col_lbl_categorical():
+    ftdf = _big_ftdf()
+    ft_clf = ColLblBasedFtClassifier('txt')
+    ft_clf.fit(ftdf[['txt']], ftdf['lbl'])
+
+    cat_df = ftdf[['txt']].astype('category')
+    assert (ft_clf.predict(cat_df) == ft_clf.predict(ftdf[['txt']])).all()
+    assert (
+        ft_clf.predict_proba(cat_df) == ft_clf.predict_proba(ftdf[['txt']])
+    ).all()
+
+
+def test_predict_iter():
+    ftdf = _big_ftdf()
+    ft_clf = FirstColFtClassifier()
+    ft_clf.fit(ftdf[['txt']], ftdf['lbl'])
+
+    preds = ft_clf.predict(ftdf[['txt']])
+    chunks = list(ft_clf.predict_iter(iter(ftdf['txt']), chunk_size=3))
+    assert [len(chunk) for chunk in chunks] == [3, 3, 2]
+    assert (np.concatenate(chunks) == preds).all()
+    probas = ft_clf.predict_proba(ftdf[['txt']])
+    chunks = list(ft_clf.predict_proba_iter(
+        (txt for txt in ftdf['txt']), chunk_size=5, dedup=True))
+    assert [chunk.shape for chunk in chunks] == [(5, 2), (3, 2)]
+    assert (np.concatenate(chunks) == probas).all()
+    mp_chunks = list(ft_clf.predict_proba_iter(
+        iter(ftdf['txt']), chunk_size=5, n_jobs=2, backend='multiprocessing'))
+    assert (np.concatenate(mp_chunks) == probas).all()
+    mp_chunks = list(ft_clf.predict_iter(
+        iter(ftdf['txt']), chunk_size=5, n_jobs=2, backend='multiprocessing'))
+    assert (np.concatenate(mp_chunks) == preds).all()
+    # dedup is honoured by the process pool too
+    doubled = list(ftdf['txt']) * 2
+    mp_chunks = list(ft_clf.predict_proba_iter(
+        iter(doubled), chunk_size=16, n_jobs=2, backend='multiprocessing',
+        dedup=True))
+    assert (np.concatenate(mp_chunks) == np.vstack([probas] * 2)).all()
+    mp_chunks = list(ft_clf.predict_iter(
+        iter(doubled), chunk_size=5, n_jobs=2, backend='multiprocessing',
+        dedup=True))
+    assert (np.concatenate(mp_chunks) == np.tile(preds, 2)).all()
+
+    with pytest.raises(NotFittedError):
+        FirstColFtClassifier().predict_iter(['woof'])
+
+
+def test_predict_topk():
+    ftdf = pd.DataFrame(
+        data=[['moo moo', 'cow'], ['woof woof', 'dog'], ['meow meow', 'cat']],
+        columns=['txt', 'lbl']
+    )
+    ft_clf = FirstColFtClassifier(lr=1.0, epoch=100)
+    ft_clf.fit(ftdf[['txt']], ftdf['lbl'])
+
+    labels, probas = ft_clf.predict_topk(ftdf[['txt']], 2)
+    assert labels.shape == (3, 2)
+    assert probas.shape == (3, 2)
+    assert list(labels[:, 0]) == ['cow', 'dog', 'cat']
+    assert (probas[:, 0] >= probas[:, 1]).all()
+    full_probas = ft_clf.predict_proba(ftdf[['txt']])
+    assert (probas[:, 0] == full_probas.max(axis=1)).all()
+
+    labels, probas = ft_clf.predict_topk(ftdf[['txt']], 10, n_jobs=2)
+    assert labels.shape == (3, 3)
+    assert (np.sort(probas, axis=1) == np.sort(full_probas, axis=1)).all()
+    dedup_labels, dedup_probas = ft_clf.predict_topk(
+        ftdf[['txt']], 10, dedup=True)
+    assert (dedup_labels == labels).all()
+    assert (dedup_probas == probas).all()
+    with pytest.raises(ValueError):
+        ft_clf.predict_topk(ftdf[['txt']], 0)
+
+
+def test_predict_proba_sparse():
+    ftdf = pd.DataFrame(
+        data=[['moo moo', 2], ['woof woof', 0], ['meow meow', 1]],
+        columns=['txt', 'lbl']
+    )
+    ft_clf = FirstColFtClassifier(lr=1.0, epoch=100)
+    ft_clf.fit(ftdf[['txt']], ftdf['lbl'])
+
+    probas = ft_clf.predict_proba(ftdf[['txt']])
+    sparse_probas = ft_clf.predict_proba(ftdf[['txt']], sparse_output=True)
+    assert isinstance(sparse_probas, csr_matrix)
+    assert (sparse_probas.toarray() == probas).all()
+
+    top1 = ft_clf.predict_proba(
+        ftdf[['txt']], sparse_output=True, k=1, n_jobs=2, chunk_size=1)
+    assert top1.nnz == 3
+    assert (top1.toarray().argmax(axis=1) == [2, 0, 1]).all()
+    assert (top1.max(axis=1).toarray().ravel() == probas.max(axis=1)).all()
+    dense_top1 = ft_clf.predict_proba(ftdf[['txt']], k=1)
+    assert (dense_top1 == top1.toarray()).all()
+
+    above = ft_clf.predict_proba(
+        ftdf[['txt']], sparse_output=True, threshold=0.5, dedup=True)
+    assert (above.toarray() == np.where(probas >= 0.5, probas, 0)).all()
+    with pytest.raises(ValueError):
+        ft_clf.predict_proba(
+            ftdf[['txt']], sparse_output=True, n_jobs=2,
+            backend='multiprocessing')
+
+
+def test_predict_proba_out_and_dtype(tmp_path):
+    ftdf = _big_ftdf()
+    ft_clf = FirstColFtClassifier()
+    ft_clf.fit(ftdf[['txt']], ftdf['lbl'])
+
+    probas = ft_clf.predict_proba(ftdf[['txt']])
+    probas32 = ft_clf.predict_proba(ftdf[['txt']], dtype=np.float32)
+    assert probas32.dtype == np.float32
+    assert (probas32 == probas.astype(np.float32)).all()
+
+    out = np.memmap(
+        str(tmp_path / 'probas.dat'), dtype=np.float32, mode='w+',
+        shape=probas.shape)
+    res = ft_clf.predict_proba(ftdf[['txt']], out=out, chunk_size=3)
+    assert res is out
+    assert (out == probas32).all()
+    out[:] = -1
+    ft_clf.predict_proba(ftdf[['txt']], out=out, dedup=True)
+    assert (out == probas32).all()
+    out = np.full(probas.shape, -1.0)
+    ft_clf.predict_proba_on_str_arr(
+        ftdf['txt'], out=out, n_jobs=2, backend='multiprocessing')
+    assert (out == probas).all()
+
+    with pytest.raises(ValueError):
+        ft_clf.predict_proba(ftdf[['txt']], out=np.empty((3, 2)))
+    with pytest.raises(ValueError, match='floating point'):
+        ft_clf.predict_proba(
+            ftdf[['txt']], out=np.zeros(probas.shape, dtype=int))
+    with pytest.raises(ValueError):
+        ft_clf.predict_proba(
+            ftdf[['txt']], out=np.empty(probas.shape), sparse_output=True)
+
+
+def test_predict_keeps_label_types():
+    ftdf = pd.DataFrame(
+        data=[['woof woof', '007'], ['meow meow', 'cat']],
+        columns=['txt', 'lbl']
+    )
+    ft_clf = SeriesFtClassifier(lr=1.0, epoch=100)
+    ft_clf.fit(ftdf['txt'], ftdf['lbl'])
+
+    preds = ft_clf.predict(ftdf['txt'])
+    assert preds.dtype == ft_clf.classes_.dtype
+    assert list(preds) == ['007', 'cat']
+    labels, _ = ft_clf.predict_topk(ftdf['txt'], 1)
+    assert list(labels[:, 0]) == ['007', 'cat']
+
+    ftdf = _ftdf()
+    ft_clf.fit(ftdf['txt'], ftdf['lbl'].astype(np.int8))
+    preds = ft_clf.predict(ftdf['txt'], n_jobs=2, backend='multiprocessing')
+    assert preds.dtype == np.int8
+
+
+def test_input_col_extraction():
+    ftdf = _big_ftdf()
+    ftdf['num'] = range(len(ftdf))
+    ft_clf = IdxBasedFtClassifier(1)
+    ft_clf.fit(ftdf[['num', 'txt']], ftdf['lbl'])
+
+    preds = ft_clf.predict(ftdf[['num', 'txt']])
+    arr = ftdf[['num', 'txt']].values
+    assert np.shares_memory(ft_clf._input_col(arr), arr)
+    assert (ft_clf.predict(arr) == preds).all()
+    rows = arr.tolist()
+    assert ft_clf._input_col(rows) == list(ftdf['txt'])
+    assert (ft_clf.predict(rows) == preds).all()
+    with pytest.raises(ValueError):
+        ft_clf.predict(list(ftdf['txt']))
+    with pytest.raises(ValueError):
+        ft_clf.predict([])
+
+
+def test_arrow_input_and_output():
+    pa = pytest.importorskip('pyarrow')
+    ftdf = _big_ftdf()
+    ft_clf = SeriesFtClassifier()
+    ft_clf.fit(ftdf['txt'], ftdf['lbl'])
+    preds = ft_clf.predict(ftdf['txt'])
+    probas = ft_clf.predict_proba(ftdf['txt'])
+
+    arrow_txt = ftdf['txt'].astype('string[pyarrow]')
+    assert (ft_clf.predict(arrow_txt, chunk_size=3) == preds).all()
+    assert (ft_clf.predict(arrow_txt, dedup=True, n_jobs=2) == preds).all()
+    chunked = pa.chunked_array([ftdf['txt'][:3], ftdf['txt'][3:]])
+    assert (ft_clf.predict_proba(chunked, n_jobs=2) == probas).all()
+    assert (ft_clf.predict_proba(chunked, dedup=True) == probas).all()
+
+    arrow_preds = ft_clf.predict_arrow(arrow_txt)
+    assert isinstance(arrow_preds, pa.Array)
+    assert arrow_preds.to_pylist() == list(preds)
+    batch = ft_clf.predict_proba_arrow(arrow_txt, dtype=np.float32)
+    assert batch.schema.names == ['0', '1']
+    assert batch.column(0).type == pa.float32()
+    assert (
+        batch.column(1).to_numpy() == probas[:, 1].astype(np.float32)
+    ).all()
+    batch = ft_clf.predict_proba_arrow(arrow_txt, n_jobs=2, dedup=True)
+    assert (batch.column(1).to_numpy() == probas[:, 1]).all()
+    with pytest.raises(TypeError, match='out'):
+        ft_clf.predict_proba_arrow(arrow_txt, out=np.empty(probas.shape))
+
+    col_clf = ColLblBasedFtClassifier('txt')
+    col_clf.fit(ftdf[['txt']], ftdf['lbl'])
+    table = pa.Table.from_pandas(ftdf[['txt']])
+    assert (col_clf.predict(table) == col_clf.predict(ftdf[['txt']])).all()
+    first_clf = FirstColFtClassifier()
+    first_clf.fit(ftdf[['txt']], ftdf['lbl'])
+    assert (first_clf.predict(table) == first_clf.predict(ftdf[['txt']])).all()
+
+
+def test_dump_xy_to_fasttext_format(tmp_path):
+    from skift.util import dump_xy_to_fasttext_format
+
+    fpath = str(tmp_path / 'dump.ft')
+    dump_xy_to_fasttext_format(
+        pd.Series(['woof woof', 'meow', 'moo']), [0, 1, 0], fpath,
+        chunk_size=2)
+    with open(fpath, encoding='utf-8') as rfile:
+        assert rfile.read() == (
+            '__label__0 woof woof\n__label__1 meow\n__label__0 moo\n')
+    dump_xy_to_fasttext_format(
+        (txt for txt in ['héllo', 7]), np.array(['a', 'b']), fpath)
+    with open(fpath, encoding='utf-8') as rfile:
+        assert rfile.read() == '__label__a héllo\n__label__b 7\n'
+
+
+def test_dump_out_of_disk_space(tmp_path, monkeypatch):
+    import errno
+    from skift import util
+
+    def no_space_left(texts, labels):
+        raise OSError(errno.ENOSPC, 'No space left on device')
+
+    monkeypatch.setattr(util, '_format_fasttext_lines', no_space_left)
+    fpath = str(tmp_path / 'dump.ft')
+    with pytest.raises(OSError) as excinfo:
+        util.dump_xy_to_fasttext_format(['woof'], [0], fpath)
+    assert excinfo.value.errno == errno.ENOSPC
+    assert util.SKIFT_TEMP_DIR_ENV_VAR in str(excinfo.value)
+    assert not os.path.exists(fpath)
+
+
+def test_dataset_cache(tmp_path, monkeypatch):
+    from skift import util
+
+    monkeypatch.setattr(
+        util.get_temp_dir_name, 'dir_name', str(tmp_path), raising=False)
+    monkeypatch.setenv(util.SKIFT_TEMP_DIR_ENV_VAR, str(tmp_path))
+    monkeypatch.setenv(util.SKIFT_DATASET_CACHE_ENV_VAR, '1')
+    dumps = []
+    dump = util.dump_xy_to_fasttext_format
+
+    def counting_dump(X, y, filepath):
+        dumps.append(filepath)
+        dump(X, y, filepath)
+
+    monkeypatch.setattr(util, 'dump_xy_to_fasttext_format', counting_dump)
+    ftdf = _big_ftdf()
+    for _ in range(2):
+        ft_clf = ColLblBasedFtClassifier('txt')
+        ft_clf.fit(ftdf[['txt']], ftdf['lbl'])
+    assert len(dumps) == 1
+    cache_dir = util.get_dataset_cache_dir()
+    assert len(os.listdir(cache_dir)) == 1
+    assert ft_clf.predict(ftdf[['txt']]).shape == (8,)
+    # different labels get a different fingerprint
+    assert util.fingerprint_xy(ftdf['txt'], ftdf['lbl']) != \
+        util.fingerprint_xy(ftdf['txt'], 1 - ftdf['lbl'])
+    ft_clf.fit(ftdf[['txt']], 1 - ftdf['lbl'])
+    assert len(dumps) == 2
+    assert len(os.listdir(cache_dir)) == 2
+    # least recently used dumps are evicted to keep under the size cap
+    monkeypatch.setenv(util.SKIFT_DATASET_CACHE_ENV_VAR, '0.0001')
+    ft_clf.fit(ftdf[['txt']].iloc[:4], ftdf['lbl'].iloc[:4])
+    assert len(os.listdir(cache_dir)) == 1
+    # but not while they are in use, e.g. by a concurrent fit
+    with util.dataset_file(ftdf['txt'], ftdf['lbl']) as in_use_fpath:
+        ft_clf.fit(ftdf[['txt']].iloc[:3], ftdf['lbl'].iloc[:3])
+        assert os.path.isfile(in_use_fpath)
+        assert len(os.listdir(cache_dir)) == 2
+    ft_clf.fit(ftdf[['txt']].iloc[:2], ftdf['lbl'].iloc[:2])
+    assert not os.path.exists(in_use_fpath)
+    util.clear_dataset_cache()
+    assert not os.path.exists(cache_dir)
+    # without SKIFT_TEMP_DIR, processes share a per-user cache directory
+    monkeypatch.delenv(util.SKIFT_TEMP_DIR_ENV_VAR)
+    monkeypatch.setattr(
+        util.tempfile, 'gettempdir', lambda: str(tmp_path / 'system'))
+    shared_dir = util.get_dataset_cache_dir()
+    assert shared_dir.startswith(str(tmp_path / 'system'))
+    assert 'skift-dataset-cache' in shared_dir
+    assert util.get_dataset_cache_dir() == shared_dir
+    # never one others can access, and so read or replace dumps in
+    if hasattr(os, 'getuid'):
+        os.chmod(shared_dir, 0o777)
+        private_dir = util.get_dataset_cache_dir()
+        assert private_dir != shared_dir
+        assert os.stat(private_dir).st_mode & 0o777 == 0o700
+
+
+def test_fit_from_file(tmp_path):
+    from skift.util import dump_xy_to_fasttext_format
+
+    ftdf = _big_ftdf()
+    fpath = str(tmp_path / 'train.ft')
+    dump_xy_to_fasttext_format(ftdf['txt'], ftdf['lbl'], fpath)
+    ft_clf = SeriesFtClassifier(lr=1.0, epoch=100)
+    ft_clf.fit_from_file(fpath)
+    assert ft_clf.classes_.tolist() == [0, 1]
+    assert ft_clf.num_classes_ == 2
+    assert ft_clf.class_labels_ == ['__label__0', '__label__1']
+    assert (ft_clf.predict(ftdf['txt']) == ftdf['lbl']).all()
+    assert ft_clf.predict_proba(ftdf['txt']).shape == (8, 2)
+    str_fpath = str(tmp_path / 'train_str.ft')
+    dump_xy_to_fasttext_format(
+        ftdf['txt'], ftdf['lbl'].map({0: 'meow', 1: 'bark'}), str_fpath)
+    ft_clf.fit_from_file(str_fpath)
+    assert ft_clf.classes_.tolist() == ['bark', 'meow']
+    # labels differing only by leading zeros are kept apart
+    zeros_fpath = str(tmp_path / 'train_zeros.ft')
+    dump_xy_to_fasttext_format(
+        ftdf['txt'], ftdf['lbl'].map({0: '7', 1: '007'}), zeros_fpath)
+    ft_clf.fit_from_file(zeros_fpath)
+    assert ft_clf.classes_.tolist() == ['007', '7']
+    preds = ft_clf.predict(ftdf['txt'])
+    assert set(preds) == {'007', '7'}
+    with pytest.raises(FileNotFoundError):
+        ft_clf.fit_from_file(str(tmp_path / 'missing.ft'))
+
+
+def test_fit_stream():
+    ftdf = _big_ftdf()
+
+    def chunks(df):
+        for start in range(0, len(df), 3):
+            chunk = df.iloc[start:start + 3]
+            yield chunk[['txt']], chunk['lbl']
+
+    ft_clf = ColLblBasedFtClassifier('txt', lr=1.0, epoch=100)
+    ft_clf.fit_stream(chunks(ftdf))
+    assert ft_clf.classes_.tolist() == [0, 1]
+    assert ft_clf.class_labels_ == ['__label__0', '__label__1']
+    assert (ft_clf.predict(ftdf[['txt']]) == ftdf['lbl']).all()
+    series_clf = SeriesFtClassifier(lr=1.0, epoch=100)
+    series_clf.fit_stream(
+        (chunk['txt'], chunk['lbl'].map({0: 'meow', 1: 'bark'}))
+        for _, chunk in ftdf.groupby(np.arange(8) // 3))
+    assert series_clf.classes_.tolist() == ['bark', 'meow']
+    with pytest.raises(ValueError):
+        ft_clf.fit_stream(iter([]))
+
+
+def test_dump_xy_parallel(tmp_path, monkeypatch):
+    from skift import util
+
+    texts = pd.Series(['woof woof', 'meow', 'moo', 'héllo', 'quack'] * 3)
+    labels = np.arange(15) % 3
+    serial_fpath = str(tmp_path / 'serial.ft')
+    parallel_fpath = str(tmp_path / 'parallel.ft')
+    util.dump_xy_to_fasttext_format(texts, labels, serial_fpath)
+    for X in [texts, texts.values, list(texts)]:
+        util.dump_xy_to_fasttext_format_parallel(
+            X, labels, parallel_fpath, n_jobs=4, chunk_size=2)
+        with open(serial_fpath, 'rb') as sfile, \
+                open(parallel_fpath, 'rb') as pfile:
+            assert sfile.read() == pfile.read()
+    util.dump_xy_to_fasttext_format_parallel(
+        texts[:2], labels[:2], parallel_fpath, n_jobs=8)
+    with open(parallel_fpath, encoding='utf-8') as rfile:
+        assert rfile.read() == '__label__0 woof woof\n__label__1 meow\n'
+    util.dump_xy_to_fasttext_format_parallel([], [], parallel_fpath)
+    assert os.path.getsize(parallel_fpath) == 0
+    assert sorted(os.listdir(str(tmp_path))) == ['parallel.ft', 'serial.ft']
+    parallel_dumps = []
+    monkeypatch.setattr(util, 'PARALLEL_DUMP_MIN_ROWS', 10)
+    monkeypatch.setattr(
+        util, 'dump_xy_to_fasttext_format_parallel',
+        lambda X, y, fpath, n_jobs: parallel_dumps.append(n_jobs))
+    monkeypatch.delenv(util.SKIFT_DUMP_N_JOBS_ENV_VAR, raising=False)
+    util.dump_xy(texts, labels, parallel_fpath)
+    assert parallel_dumps == []
+    monkeypatch.setenv(util.SKIFT_DUMP_N_JOBS_ENV_VAR, '2')
+    util.dump_xy(texts, labels, parallel_fpath)
+    util.dump_xy(texts[:5], labels[:5], parallel_fpath)
+    assert parallel_dumps == [2]
+
+
+def test_temp_file_manager(tmp_path, monkeypatch):
+    import subprocess
+    import sys
+    from skift import util
+
+    monkeypatch.setattr(
+        util.get_temp_dir_name, 'dir_name', str(tmp_path), raising=False)
+    fpaths = {util.temp_dataset_fpath() for _ in range(100)}
+    assert len(fpaths) == 100
+    assert all(os.path.isfile(fpath) for fpath in fpaths)
+    with util.temp_file('model') as model_fpath:
+        assert str(os.getpid()) in os.path.basename(model_fpath)
+    assert not os.path.exists(model_fpath)
+    if util.fcntl is None:
+        util._remove_live_temp_files()
+        pytest.skip("Sweeping orphaned temp files needs flock")
+    # unlocked files of dead processes are swept, locked live ones are kept
+    other = subprocess.Popen(
+        [sys.executable, '-c', (
+            "from skift import util; "
+            "print(util.temp_dataset_fpath(), flush=True); input()")],
+        env=dict(os.environ, SKIFT_TEMP_DIR=str(tmp_path)),
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        universal_newlines=True)
+    other_fpath = other.stdout.readline().strip()
+    orphan = str(tmp_path / 'temp_ft_trainset_{}_x.ft'.format(os.getpid()))
+    open(orphan, 'w').close()
+    assert util.sweep_orphaned_temp_files() == [orphan]
+    assert all(os.path.isfile(fpath) for fpath in fpaths)
+    assert os.path.isfile(other_fpath)
+    other.kill()
+    other.wait()
+    assert util.sweep_orphaned_temp_files() == [other_fpath]
+    util._remove_live_temp_files()
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_fit_failure_removes_temp_files(tmp_path, monkeypatch):
+    from skift import core, util
+
+    def failing_train_supervised(input, **kwargs):
+        assert os.path.isfile(input)
+        raise RuntimeError('training failed')
+
+    monkeypatch.setattr(
+        util.get_temp_dir_name, 'dir_name', str(tmp_path), raising=False)
+    monkeypatch.setattr(core, 'train_supervised', failing_train_supervised)
+    monkeypatch.setenv(util.SKIFT_RAM_BUDGET_ENV_VAR, '0')
+    ftdf = _big_ftdf()
+    ft_clf = ColLblBasedFtClassifier('txt')
+    with pytest.raises(RuntimeError):
+        ft_clf.fit(ftdf[['txt']], ftdf['lbl'])
+    with pytest.raises(RuntimeError):
+        ft_clf.fit_stream([(ftdf[['txt']], ftdf['lbl'])])
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_ram_staging(tmp_path, monkeypatch):
+    from skift import util
+
+    if not hasattr(os, 'statvfs'):
+        pytest.skip("RAM staging needs os.statvfs")
+    ram_dir = tmp_path / 'ram'
+    ram_dir.mkdir()
+    monkeypatch.setenv(util.SKIFT_RAM_TEMP_DIR_ENV_VAR, str(ram_dir))
+    monkeypatch.setenv(util.SKIFT_RAM_BUDGET_ENV_VAR, '1')
+    with util.temp_file('model', size_hint=1000) as fpath:
+        assert util.staging_tier(fpath) == util.RAM_TIER
+        assert fpath.startswith(str(ram_dir))
+    for size_hint in [None, 2 ** 21]:
+        with util.temp_file('model', size_hint=size_hint) as fpath:
+            assert util.staging_tier(fpath) == util.DISK_TIER
+            assert not fpath.startswith(str(ram_dir))
+    # files staged by this process share the budget
+    with util.temp_file('model', size_hint=2 ** 19) as fpath:
+        assert util.staging_tier(fpath) == util.RAM_TIER
+        with util.temp_file('model', size_hint=2 ** 19 + 1) as fpath:
+            assert util.staging_tier(fpath) == util.DISK_TIER
+    with util.temp_file('model', size_hint=2 ** 19 + 1) as fpath:
+        assert util.staging_tier(fpath) == util.RAM_TIER
+    # the budget is capped by the available memory
+    monkeypatch.setattr(util, 'get_available_memory', lambda: 1000)
+    assert util.get_ram_budget(str(ram_dir)) == 1000
+    monkeypatch.delenv(util.SKIFT_RAM_BUDGET_ENV_VAR)
+    assert util.get_ram_budget(str(ram_dir)) == 500
+    monkeypatch.setenv(util.SKIFT_RAM_BUDGET_ENV_VAR, '0')
+    with util.temp_file('model', size_hint=1) as fpath:
+        assert util.staging_tier(fpath) == util.DISK_TIER
+    assert util.staging_tier(fpath) is None
+    ftdf = _big_ftdf()
+    assert util.estimate_dump_size(ftdf['txt'], ftdf['lbl']) == len(
+        util._format_fasttext_lines(ftdf['txt'].tolist(), ftdf['lbl']))
+    # sampled over all rows, not just the first ones
+    texts = pd.Series(['a'] * 2000 + ['b' * 100] * 2000)
+    labels = np.zeros(len(texts), dtype=int)
+    actual_size = len(util._format_fasttext_lines(texts.tolist(), labels))
+    for X in [texts, texts.values, list(texts)]:
+        estimate = util.estimate_dump_size(X, labels)
+        assert abs(estimate - actual_size) < 0.01 * actual_size
+    ft_clf = ColLblBasedFtClassifier('txt')
+    ft_clf.fit(ftdf[['txt']], ftdf['lbl'])
+    model_bytes = util.python_fasttext_model_to_bytes(ft_clf.model)
+    assert len(model_bytes) <= util.estimate_model_size(ft_clf.model)
+
+
+def test_ram_temp_dir_is_private(tmp_path, monkeypatch):
+    from skift import util
+
+    if not hasattr(os, 'getuid'):
+        pytest.skip("Directory ownership checks need os.getuid")
+    monkeypatch.setenv(util.SKIFT_RAM_TEMP_DIR_ENV_VAR, str(tmp_path))
+    shared_dir = tmp_path / 'skift-{}'.format(os.getuid())
+    assert util.get_ram_temp_dir_name() == str(shared_dir)
+    assert util.get_ram_temp_dir_name() == str(shared_dir)
+    # taken by a directory others can access, or by a link to one
+    shared_dir.chmod(0o777)
+    fallback_dir = util.get_ram_temp_dir_name()
+    assert fallback_dir != str(shared_dir)
+    assert os.stat(fallback_dir).st_mode & 0o777 == 0o700
+    assert util.get_ram_temp_dir_name() == fallback_dir
+    shared_dir.rmdir()
+    shared_dir.symlink_to(fallback_dir)
+    assert util.get_ram_temp_dir_name() == fallback_dir
+    util._remove_fallback_dirs()
+    assert not os.path.exists(fallback_dir)
+
+
+def test_ram_staging_falls_back_to_disk(tmp_path, monkeypatch):
+    import errno
+    from skift import util
+
+    if not hasattr(os, 'statvfs'):
+        pytest.skip("RAM staging needs os.statvfs")
+    ram_dir = tmp_path / 'ram'
+    ram_dir.mkdir()
+    disk_dir = tmp_path / 'disk'
+    disk_dir.mkdir()
+    monkeypatch.setenv(util.SKIFT_RAM_TEMP_DIR_ENV_VAR, str(ram_dir))
+    monkeypatch.setenv(util.SKIFT_RAM_BUDGET_ENV_VAR, '1')
+    monkeypatch.setattr(
+        util.get_temp_dir_name, 'dir_name', str(disk_dir), raising=False)
+    dump_xy = util.dump_xy
+
+    def ram_full_dump_xy(X, y, filepath):
+        if filepath.startswith(str(ram_dir)):
+            raise OSError(errno.ENOSPC, 'No space left on device')
+        dump_xy(X, y, filepath)
+
+    monkeypatch.setattr(util, 'dump_xy', ram_full_dump_xy)
+    texts, labels = ['woof', 'meow'], [0, 1]
+    with util.dataset_file(texts, labels) as fpath:
+        assert util.staging_tier(fpath) == util.DISK_TIER
+        assert fpath.startswith(str(disk_dir))
+        with open(fpath, encoding='utf-8') as rfile:
+            assert rfile.read() == '__label__0 woof\n__label__1 meow\n'
+    assert [fnames for _, _, fnames in os.walk(str(tmp_path))] == [[]] * 4
+
+    def write_to_full_device(wfile):
+        raise OSError(errno.ENOSPC, 'No space left on device')
+
+    with util.temp_file('trainset', size_hint=10) as fpath:
+        assert util.staging_tier(fpath) == util.RAM_TIER
+        with pytest.raises(OSError, match=util.SKIFT_RAM_BUDGET_ENV_VAR):
+            util._dump_to_file(fpath, write_to_full_device)
+
+
+def test_mmap_classifier(tmp_path, monkeypatch):
+    import pickle
+    from skift import load_mmap_classifier
+    from skift.mmap_model import MmapFastTextModel
+
+    ftdf = _big_ftdf()
+    texts = ftdf[['txt']].copy()
+    texts.loc[8] = ['unseen héllo words']
+    ft_clf = ColLblBasedFtClassifier(
+        'txt', lr=1.0, epoch=100, minn=2, maxn=4, wordNgrams=2)
+    ft_clf.fit(ftdf[['txt']], ftdf['lbl'])
+    ft_clf.save_mmap(str(tmp_path / 'clf'))
+    mmap_clf = load_mmap_classifier(str(tmp_path / 'clf'))
+    assert isinstance(mmap_clf, ColLblBasedFtClassifier)
+    assert isinstance(mmap_clf.model, MmapFastTextModel)
+    assert isinstance(mmap_clf.model.input_matrix, np.memmap)
+    # so is the vocabulary, rather than held as per-process strs
+    assert isinstance(mmap_clf.model.word_bytes, np.memmap)
+    assert 'words' not in vars(mmap_clf.model)
+    assert mmap_clf.model.words == ft_clf.model.words
+    assert (mmap_clf.predict(texts) == ft_clf.predict(texts)).all()
+    np.testing.assert_allclose(
+        mmap_clf.predict_proba(texts), ft_clf.predict_proba(texts),
+        atol=1e-6)
+    assert ft_clf.model.predict('woof meow', k=-1)[0] == \
+        mmap_clf.model.predict('woof meow', k=-1)[0]
+    # pickled by reference, and shared by worker processes
+    mmap_clf2 = pickle.loads(pickle.dumps(mmap_clf))
+    assert isinstance(mmap_clf2.model.input_matrix, np.memmap)
+    assert (mmap_clf2.predict(
+        texts, n_jobs=2, backend='multiprocessing') == ft_clf.predict(
+            texts)).all()
+    with pytest.raises(ValueError):
+        mmap_clf.quantize()
+    # relative paths are resolved, so pickles outlive the working directory
+    monkeypatch.chdir(str(tmp_path))
+    rel_clf = load_mmap_classifier('clf')
+    assert rel_clf.model.dirpath == str(tmp_path / 'clf')
+    monkeypatch.chdir('/')
+    rel_clf = pickle.loads(pickle.dumps(rel_clf))
+    assert (rel_clf.predict(texts) == ft_clf.predict(texts)).all()
+    # sigmoid losses saturate, so labels often tie on probability
+    ova_clf = ColLblBasedFtClassifier('txt', lr=1.0, epoch=100, loss='ova')
+    ova_clf.fit(ftdf[['txt']], ftdf['lbl'])
+    ova_clf.save_mmap(str(tmp_path / 'ova_clf'))
+    ova_model = load_mmap_classifier(str(tmp_path / 'ova_clf')).model
+    txts = texts['txt'].tolist()
+    for k, threshold in [(1, 0.0), (-1, 0.0), (2, 0.5)]:
+        labels, probs = ova_clf.model.predict(txts, k, threshold)
+        mmap_labels, mmap_probs = ova_model.predict(txts, k, threshold)
+        assert labels == mmap_labels
+        for row_probs, mmap_row_probs in zip(probs, mmap_probs):
+            np.testing.assert_allclose(row_probs, mmap_row_probs, atol=1e-6)
+    hs_clf = ColLblBasedFtClassifier('txt', loss='hs')
+    hs_clf.fit(ftdf[['txt']], ftdf['lbl'])
+    with pytest.raises(ValueError):
+        hs_clf.save_mmap(str(tmp_path / 'hs_clf'))
+    with pytest.raises(NotFittedError):
+        ColLblBasedFtClassifier('txt').save_mmap(str(tmp_path / 'unfitted'))
+
+
+def test_mmap_model_matches_fasttext(tmp_path):
+    from fasttext import train_supervised
+    from skift.mmap_model import MmapFastTextModel, export_fasttext_model
+
+    rng = np.random.RandomState(0)
+    vocab = np.array(['w{}'.format(i) for i in range(300)] + [
+        'héllo', 'naïve', '日本語'])
+    fpath = str(tmp_path / 'train.ft')
+    with open(fpath, 'w', encoding='utf-8') as wfile:
+        for words in rng.choice(vocab, size=(3000, 6)):
+            lbl = rng.randint(5)
+            wfile.write('__label__{} {} c{}\n'.format(
+                lbl, ' '.join(words), lbl))
+    texts = [
+        ' '.join(words) + ' c{}'.format(rng.randint(6))
+        for words in rng.choice(vocab, size=(200, 5))]
+    texts += ['', 'unseen tokens', 'héllo\t日本語  zzz', '__label__1 w1']
+    for loss in ['softmax', 'ns']:
+        model = train_supervised(
+            input=fpath, epoch=5, loss=loss, minn=2, maxn=4, wordNgrams=2,
+            bucket=5000)
+        export_fasttext_model(model, str(tmp_path / loss))
+        mmap_model = MmapFastTextModel(str(tmp_path / loss))
+        all_labels, all_probs = model.predict(texts, -1)
+        mmap_labels, mmap_probs = mmap_model.predict(texts, -1)
+        for row in range(len(texts)):
+            np.testing.assert_allclose(
+                [dict(zip(all_labels[row], all_probs[row]))[lbl]
+                 for lbl in mmap_labels[row]],
+                mmap_probs[row], atol=1e-6)
+        # labels only rank differently when float rounding breaks near-ties
+        gaps = [np.diff(row_probs) for row_probs in all_probs]
+        exact_rows = [
+            row for row in range(len(texts))
+            if not ((gaps[row] < 0) & (gaps[row] > -1e-6)).any()]
+        assert len(exact_rows) > len(texts) / 2
+        for k, threshold in [(1, 0.0), (-1, 0.0), (3, 0.1)]:
+            labels, _ = model.predict(texts, k, threshold)
+            mmap_labels, _ = mmap_model.predict(texts, k, threshold)
+            for row in exact_rows:
+                assert labels[row] == mmap_labels[row]
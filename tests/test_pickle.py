@@ -10,6 +10,7 @@ import tempfile
 from sklearn.exceptions import NotFittedError
 
 from skift import FirstColFtClassifier
+from skift.util import python_fasttext_model_to_bytes
 
 
 @pytest.mark.parametrize("quantize", [True, False])
@@ -91,3 +92,112 @@ def test_pickle_unfitted():
     # Clean up
     os.close(fd)    # Prevent a file-handle leak
     os.unlink(pic_fpath)
+
+
+def test_pickle_prediction_cache():
+    ftdf = pd.DataFrame(
+        data=[['woof woof', 0], ['meow meow', 1]],
+        columns=['txt', 'lbl']
+    )
+    ft_clf = FirstColFtClassifier()
+    ft_clf.set_prediction_cache(maxsize=10)
+    ft_clf.fit(ftdf[['txt']], ftdf['lbl'])
+    ft_clf.predict(ftdf[['txt']])
+    assert ft_clf.prediction_cache_info().currsize == 2
+
+    ft_clf2 = pickle.loads(pickle.dumps(ft_clf))
+    info = ft_clf2.prediction_cache_info()
+    assert (info.maxsize, info.currsize) == (10, 0)
+    assert (ft_clf2.predict(ftdf[['txt']]) == [0, 1]).all()
+
+
+@pytest.mark.parametrize("memfd", [True, False])
+def test_pickle_in_memory(memfd, tmp_path, monkeypatch):
+    from skift import util
+
+    if memfd and not util.MEMFD_SUPPORTED:
+        pytest.skip("memfd_create is not supported on this platform")
+    monkeypatch.setattr(util, 'MEMFD_SUPPORTED', memfd)
+    monkeypatch.setattr(
+        util.get_temp_dir_name, 'dir_name', str(tmp_path), raising=False)
+    monkeypatch.setenv(util.SKIFT_RAM_BUDGET_ENV_VAR, '0')
+    ftdf = pd.DataFrame(
+        data=[['woof woof', 0], ['meow meow', 1]],
+        columns=['txt', 'lbl']
+    )
+    ft_clf = FirstColFtClassifier()
+    ft_clf.fit(ftdf[['txt']], ftdf['lbl'])
+    saved_models = []
+    save_model = util._save_and_read_model
+
+    def recording_save(model, fpath):
+        saved_models.append(fpath)
+        return save_model(model, fpath)
+
+    monkeypatch.setattr(util, '_save_and_read_model', recording_save)
+    ft_clf2 = pickle.loads(pickle.dumps(ft_clf))
+    assert (ft_clf2.predict(ftdf[['txt']]) == [0, 1]).all()
+    assert saved_models[0].startswith('/proc/self/fd/') == memfd
+    assert os.listdir(str(tmp_path)) == []
+
+
+@pytest.mark.skipif(
+    pickle.HIGHEST_PROTOCOL < 5, reason="requires pickle protocol 5")
+def test_pickle_out_of_band_model():
+    ftdf = pd.DataFrame(
+        data=[['woof woof', 0], ['meow meow', 1]],
+        columns=['txt', 'lbl']
+    )
+    ft_clf = FirstColFtClassifier()
+    ft_clf.fit(ftdf[['txt']], ftdf['lbl'])
+    buffers = []
+    data = pickle.dumps(ft_clf, protocol=5, buffer_callback=buffers.append)
+    # numpy arrays, like classes_, are handed out-of-band as well
+    model_size = len(python_fasttext_model_to_bytes(ft_clf.model))
+    assert model_size in [buf.raw().nbytes for buf in buffers]
+    assert len(data) < model_size
+    ft_clf2 = pickle.loads(data, buffers=buffers)
+    assert (ft_clf2.predict(ftdf[['txt']]) == [0, 1]).all()
+    # in-band pickling still works, with any protocol
+    for protocol in [2, 4, 5]:
+        ft_clf3 = pickle.loads(pickle.dumps(ft_clf, protocol=protocol))
+        assert (ft_clf3.predict(ftdf[['txt']]) == [0, 1]).all()
+    unfitted = pickle.loads(pickle.dumps(FirstColFtClassifier(), protocol=5))
+    assert unfitted.model is None
+
+
+def test_pickle_lazy_load(monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    from skift import core, util
+
+    ftdf = pd.DataFrame(
+        data=[['woof woof', 0], ['meow meow', 1]],
+        columns=['txt', 'lbl']
+    )
+    ft_clf = FirstColFtClassifier()
+    ft_clf.fit(ftdf[['txt']], ftdf['lbl'])
+    data = pickle.dumps(ft_clf)
+    monkeypatch.setenv(util.SKIFT_LAZY_LOAD_ENV_VAR, '1')
+    loads = []
+    to_model = core.bytes_to_python_fasttext_model
+
+    def counting_to_model(bytes_obj):
+        loads.append(bytes_obj)
+        return to_model(bytes_obj)
+
+    monkeypatch.setattr(
+        core, 'bytes_to_python_fasttext_model', counting_to_model)
+    ft_clf2 = pickle.loads(data)
+    assert not ft_clf2.is_model_loaded()
+    # passing it on does not load the model either
+    ft_clf3 = pickle.loads(pickle.dumps(ft_clf2))
+    assert loads == []
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(
+            lambda _: ft_clf3.predict(ftdf[['txt']]).tolist(), range(8)))
+    assert results == [[0, 1]] * 8
+    assert len(loads) == 1
+    assert ft_clf3.is_model_loaded()
+    assert not ft_clf2.is_model_loaded()
+    assert ft_clf2.is_quantized() is False
+    assert len(loads) == 2